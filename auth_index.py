@@ -0,0 +1,38 @@
+import threading
+
+
+# Lookup tables for authorization. A new index is built on every refresh and swapped in as a whole,
+# so handlers never see a half-built index.
+class AuthIndex:
+    def __init__(self, users, admins, previous=None):
+        self.by_username = users
+        self.admins = frozenset(admins)
+        self.by_user_id = {}
+        self._lock = threading.Lock()  # guards by_user_id and user_id of the users against concurrent logins
+        # keep telegram ids learned before the refresh, logins go on in the handlers meanwhile
+        if previous is not None:
+            with previous._lock:
+                learned = dict(previous.by_user_id)
+            for user_id, user_info in learned.items():
+                refreshed_info = users.get(user_info['username'])
+                if refreshed_info is not None:
+                    refreshed_info['user_id'] = user_id
+        for user_info in users.values():
+            if user_info['user_id'] is not None:
+                self.by_user_id[user_info['user_id']] = user_info
+
+    def find_user(self, from_user):
+        user_info = self.by_user_id.get(from_user.id)
+        # usernames can be changed in telegram, access is granted by username
+        if user_info is not None and user_info['username'] == from_user.username:
+            return user_info
+        return self.by_username.get(from_user.username)
+
+    def set_user_id(self, username, user_id):
+        user_info = self.by_username[username]
+        with self._lock:
+            user_info['user_id'] = user_id
+            self.by_user_id[user_id] = user_info
+
+    def is_admin(self, from_user):
+        return from_user.username in self.admins
@@ -0,0 +1,49 @@
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from sqlalchemy.exc import IntegrityError
+
+import bench_db
+import db_access
+
+# Saving one report of visits: DataFrame.to_sql (before) vs. row tuples through executemany (after).
+# Usage: python benchmarks/bench_bulk_write.py [reports] [members]  (BENCH_DB_URL selects the database, default SQLite)
+
+
+def get_rows(report, members):
+    visit_date = date(2021, 1, 1) + timedelta(days=report)
+    date_processed = datetime.now()
+    return [{'name_leader': 'Лидер', 'id_hg': 'HG-000', 'name': f'Участник {m}', 'status': '+', 'type_person': 'Член',
+             'reason': None, 'date': visit_date, 'date_processed': date_processed} for m in range(members)]
+
+
+def save_visitors_to_db_before(rows, engine):
+    pd.DataFrame(rows).to_sql(db_access.VISITS_TABLE, engine, if_exists='append', index=None)
+
+
+def measure(save, engine, first_report, reports, members):
+    reports_rows = [get_rows(first_report + r, members) for r in range(reports)]
+    start = time.perf_counter()
+    for rows in reports_rows:
+        save(rows, engine)
+    return (time.perf_counter() - start) / reports * 1e3
+
+
+def main(reports, members):
+    engine = bench_db.create_bench_engine()
+    bench_db.create_schema(engine)
+    print(f'{engine.dialect.name}, {reports} reports of {members} visits')
+    print(f'to_sql:      {measure(save_visitors_to_db_before, engine, 0, reports, members):8.2f} ms per report')
+    print(f'executemany: {measure(db_access.save_visitors_to_db, engine, reports, reports, members):8.2f} ms per report')
+
+    try:
+        db_access.save_visitors_to_db(get_rows(0, members), engine)
+        print('duplicate report was saved: IntegrityError expected')
+    except IntegrityError:
+        print('duplicate report rejected with IntegrityError')
+
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 20)
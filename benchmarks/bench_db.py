@@ -0,0 +1,66 @@
+import os
+import sys
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db_access
+
+# Local database for the benchmarks: BENCH_DB_URL (e.g. a local postgres) or SQLite (in memory unless a path is given)
+
+SCHEMA = [
+    f'CREATE TABLE {db_access.USERNAMES_TABLE} (id_hg varchar(32), leader varchar(64), usernames varchar(256))',
+    f'CREATE TABLE {db_access.VISITORS_TABLE} (id_hg varchar(32), name varchar(64))',
+    f'CREATE TABLE {db_access.VISITS_TABLE} (name_leader varchar(64), id_hg varchar(32), name varchar(64), '
+    'status varchar(1), type_person varchar(16), reason varchar(64), date date, date_processed timestamp, '
+    'UNIQUE (id_hg, name, date))',
+    f'CREATE TABLE {db_access.QUESTIONS_TABLE} (name_leader varchar(64), id_hg varchar(32), date date, '
+    'summary text, distributed_people_feedback text, testimony text, personal_meeting text, UNIQUE (id_hg, date))',
+    f'CREATE TABLE {db_access.USERS_TABLE} (telegram_username varchar(64) PRIMARY KEY, telegram_uid bigint, '
+    'user_state integer, updated_ts timestamp)',
+    f'CREATE TABLE {db_access.KEY_VALUE_TABLE} (key varchar(64), value text, multivalue_seq_number integer, '
+    'is_enabled boolean)',
+]
+
+
+def create_bench_engine(sqlite_path=None):
+    url = os.environ.get('BENCH_DB_URL')
+    if url:
+        return create_engine(url)
+    if sqlite_path:
+        # a file database, so that concurrent handlers get their own connections
+        return create_engine(f'sqlite:///{sqlite_path}', connect_args={'check_same_thread': False, 'timeout': 30})
+    return create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+
+
+def create_schema(engine, groups=50, members_per_group=20):
+    for table in [db_access.USERNAMES_TABLE, db_access.VISITORS_TABLE, db_access.VISITS_TABLE,
+                  db_access.QUESTIONS_TABLE, db_access.USERS_TABLE, db_access.KEY_VALUE_TABLE]:
+        engine.execute(f'DROP TABLE IF EXISTS {table}')
+    for statement in SCHEMA:
+        engine.execute(statement)
+
+    for g in range(groups):
+        id_hg = group_id(g)
+        engine.execute(text(f'INSERT INTO {db_access.USERNAMES_TABLE} VALUES (:id_hg, :leader, :usernames)'),
+                       id_hg=id_hg, leader=f'Лидер {g}', usernames=f'@{leader_username(g)}')
+        engine.execute(text(f'INSERT INTO {db_access.VISITORS_TABLE} VALUES (:id_hg, :name)'),
+                       [{'id_hg': id_hg, 'name': f"Участник {g}-{m}"} for m in range(members_per_group)])
+        engine.execute(text(f'INSERT INTO {db_access.USERS_TABLE} (telegram_username, telegram_uid) '
+                                      'VALUES (:username, :uid)'),
+                       username=leader_username(g), uid=1000 + g)
+    engine.execute(text(f'INSERT INTO {db_access.KEY_VALUE_TABLE} VALUES (:key, :value, :seq, :enabled)'),
+                   [{'key': 'thank_you_message', 'value': 'Спасибо!', 'seq': 1, 'enabled': True},
+                    {'key': 'thank_you_message', 'value': "Спасибо, что заполнили отчет!", 'seq': 2, 'enabled': True},
+                    {'key': 'feedback_message', 'value': 'Напишите нам', 'seq': 1, 'enabled': True},
+                    {'key': 'reminder_template', 'value': 'Группа {id_hg}: последний отчет {date_text}', 'seq': 1,
+                     'enabled': True}])
+
+
+def group_id(g):
+    return f'HG-{g:03d}'
+
+
+def leader_username(g):
+    return f'leader_{g}'
@@ -0,0 +1,59 @@
+import time
+
+import bench_db
+import db_access
+
+# Per-call latency of the hot lookups: the original code (pandas, SQL built with f-strings) vs. cached statements with
+# bound parameters.
+# Usage: python benchmarks/bench_db_access.py [iterations]  (BENCH_DB_URL selects the database, default SQLite)
+
+
+def select_leader_usernames_before(engine):
+    import pandas as pd
+    usernames_df = pd.read_sql(f'select * from {db_access.USERNAMES_TABLE}', engine)
+    users = {}
+    for i, group in usernames_df.iterrows():
+        for username in group.usernames.split(','):
+            username_no_handle = username.replace('@', '')
+            if username_no_handle:
+                user_info = users.get(username_no_handle, {'user_id': None, 'username': username_no_handle, 'hgs': []})
+                user_info['hgs'].append({'group_id': group['id_hg'], 'leader': group['leader']})
+                users[username_no_handle] = user_info
+    return users
+
+
+def select_group_members_before(group_id, engine):
+    import pandas as pd
+    members_df = pd.read_sql(f"select name from {db_access.VISITORS_TABLE} where id_hg = '{group_id}'", engine)
+    return members_df['name'].tolist()
+
+
+def measure(fn, args, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(*args(i))
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations):
+    engine = bench_db.create_bench_engine()
+    bench_db.create_schema(engine)
+    groups = 50
+    cases = [
+        ('select_leader_usernames', select_leader_usernames_before, db_access.select_leader_usernames,
+         lambda i: (engine,)),
+        ('select_group_members', select_group_members_before, db_access.select_group_members,
+         lambda i: (bench_db.group_id(i % groups), engine)),
+    ]
+    print(f'{engine.dialect.name}, {iterations} calls per case')
+    print(f'{"function":<24}{"before, us":>12}{"after, us":>12}')
+    for name, before, after, args in cases:
+        # warm up connections and statement caches
+        measure(before, args, 10)
+        measure(after, args, 10)
+        print(f'{name:<24}{measure(before, args, iterations):>12.1f}{measure(after, args, iterations):>12.1f}')
+
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
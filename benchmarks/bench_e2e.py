@@ -0,0 +1,153 @@
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import event, text
+
+import bench_db
+import fake_bot_api
+
+# hgbot reads its settings at import: dummy secrets, quiet logs, no per-chat throttling of the simulated chats
+for name, value in [('DB_USER', 'bench'), ('DB_PASSWORD', 'bench'), ('DB_HOSTNAME', 'localhost'), ('DB_NAME', 'bench'),
+                    ('BOT_TOKEN', '1:bench'), ('SENTRY_URL', ''), ('ADMINS', 'bench_admin'), ('LOG_LEVEL', 'WARNING'),
+                    ('LOG_PATH', os.path.join(tempfile.gettempdir(), 'hgbot_bench.log')),
+                    ('OUTBOUND_BOT_RATE', '100000'), ('OUTBOUND_CHAT_RATE', '100000'), ('OUTBOUND_CHAT_BURST', '100000')]:
+    os.environ.setdefault(name, value)
+
+from telebot import apihelper
+from telebot.types import Update
+
+import db_access
+import db_engine
+import metrics
+
+# End-to-end run of the real handlers of hgbot.py: N simulated leaders fill in a full report concurrently
+# (start, date, attendance, guests, summary, questions) against a local database and an in-process fake Bot API.
+# Reports throughput, p50/p99 per step, DB queries and Telegram calls per report.
+# Usage: python benchmarks/bench_e2e.py [leaders] [members_per_group] [api_latency_ms]
+#        (BENCH_DB_URL selects the database, default a temporary SQLite file)
+
+
+class Leader:
+    def __init__(self, g, members):
+        self.user_id = 1000 + g
+        self.username = bench_db.leader_username(g)
+        self.members = members
+        self._update_ids = itertools.count(self.user_id * 1000)
+
+    def user(self):
+        return {'id': self.user_id, 'is_bot': False, 'first_name': 'Лидер', 'username': self.username}
+
+    def message(self, text):
+        update_id = next(self._update_ids)
+        return Update.de_json({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text, 'from': self.user(),
+            'chat': {'id': self.user_id, 'type': 'private'}}})
+
+    def click(self, data):
+        update_id = next(self._update_ids)
+        return Update.de_json({'update_id': update_id, 'callback_query': {
+            'id': f'{self.user_id}-{update_id}', 'from': self.user(), 'chat_instance': str(self.user_id), 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': self.user_id, 'type': 'private'}}}})
+
+    # (step, update) of a full report
+    def report(self):
+        steps = [('start', self.message('/start')), ('date', self.message('✔️ Сегодня')),
+                 ('mark absent', self.click('MARK:0:-')), ('reason', self.click('REASON_work')),
+                 ('mark present', self.click('MARK:1:+'))]
+        if self.members > 8:
+            steps.append(('page', self.click('PAGE:1')))
+        steps += [('all present', self.click('ALL_PRESENT')), ('review', self.click('REVIEW')),
+                  ('complete', self.click('COMPLETE_VISITORS')), ('guest', self.message('Гость Новый')),
+                  ('finish guests', self.click('FINISH_GUESTS')), ('summary', self.message('Тезисы')),
+                  ('confirm summary', self.click('YES')), ('testimonies', self.click('NO')),
+                  ('personal meetings', self.click('NO')), ('distributed people', self.click('NO'))]
+        return steps
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def wait_for_outbound(api, outbound):
+    last, stable_since = -1, time.perf_counter()
+    while time.perf_counter() - stable_since < 0.2:
+        total = api.total() + outbound.DISPATCHER.failed
+        if total != last or sum(outbound.DISPATCHER.queue_depth().values()):
+            last, stable_since = total, time.perf_counter()
+        time.sleep(0.01)
+
+
+def main(leaders, members_per_group, api_latency_ms):
+    sqlite_path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    engine = bench_db.create_bench_engine(sqlite_path)
+    bench_db.create_schema(engine, groups=leaders, members_per_group=members_per_group)
+    db_engine.set_engine(engine)
+
+    queries = [0]
+    queries_lock = threading.Lock()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        with queries_lock:
+            queries[0] += 1
+
+    api = fake_bot_api.FakeBotApi(api_latency_ms / 1000)
+    apihelper._make_request = api.make_request
+
+    import hgbot
+    import outbound
+    hgbot.bot.threaded = False
+    hgbot.init()
+
+    simulated = [Leader(g, members_per_group) for g in range(leaders)]
+    latencies = {}  # step: [seconds]
+    lock = threading.Lock()
+    queries[0] = 0
+    errors_before = metrics.ERRORS.total()
+
+    def run_leader(leader):
+        for step, update in leader.report():
+            start = time.perf_counter()
+            hgbot.bot.process_new_updates([update])
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.setdefault(step, []).append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_leader, args=(leader,)) for leader in simulated]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    handled = time.perf_counter() - start
+    wait_for_outbound(api, outbound)
+    delivered = time.perf_counter() - start
+
+    visits = engine.execute(text(f'SELECT count(*) FROM {db_access.VISITS_TABLE}')).scalar()
+    questions = engine.execute(text(f'SELECT count(*) FROM {db_access.QUESTIONS_TABLE}')).scalar()
+
+    print(f'{leaders} leaders, {members_per_group} members per group, Bot API latency {api_latency_ms} ms, '
+          f'database {engine.url.drivername}')
+    print(f'handled in {handled:.2f}s ({leaders / handled:.1f} reports/s), '
+          f'all Bot API calls done in {delivered:.2f}s')
+    print(f'{"step":<20}{"p50 ms":>10}{"p99 ms":>10}')
+    for step, values in latencies.items():
+        print(f'{step:<20}{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}')
+    print(f'DB queries per report: {queries[0] / leaders:.1f}')
+    print(f'Telegram calls per report: {api.total() / leaders:.1f} '
+          f'({", ".join(f"{method} {count / leaders:.1f}" for method, count in sorted(api.calls.items()))})')
+    attendance = hgbot.ATTENDANCE_CALLS
+    print(f'Telegram calls while marking attendance: {attendance["calls"] / max(attendance["reports"], 1):.1f} '
+          f'per report ({attendance["reports"]} reports)')
+    print(f'saved: {visits} visits (expected {leaders * (members_per_group + 1)}), '
+          f'{questions} questions (expected {leaders}), errors logged: {metrics.ERRORS.total() - errors_before}')
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    defaults = [20, 20, 20]
+    main(*(args + defaults[len(args):]))
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import telebot
+from telebot.types import Update
+
+import update_pipeline
+
+# Throughput of the update loop: telebot's threaded processing (current loop, 2 workers by default) vs. the asyncio
+# pipeline, both also compared at the same number of workers. Handlers sleep to simulate blocking Postgres / Bot API
+# calls; the pipeline also checks per-user ordering.
+# Usage: python benchmarks/bench_pipeline.py [users] [updates_per_user] [handler_ms] [workers]
+
+
+def make_updates(users, updates_per_user):
+    updates = []
+    for n in range(updates_per_user):
+        for user_id in range(1, users + 1):
+            update_id = len(updates) + 1
+            updates.append(Update.de_json({
+                'update_id': update_id,
+                'message': {'message_id': update_id, 'date': 0, 'text': str(n),
+                            'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                            'chat': {'id': user_id, 'type': 'private'}}}))
+    return updates
+
+
+def make_bot(handler_seconds, handled, num_threads=2):
+    bot = telebot.TeleBot('1:bench', num_threads=num_threads)
+    lock = threading.Lock()
+
+    @bot.message_handler(func=lambda message: True)
+    def handle(message):
+        time.sleep(handler_seconds)
+        with lock:
+            handled.append((message.from_user.id, int(message.text)))
+
+    return bot
+
+
+def run_telebot_threaded(updates, handler_seconds, workers):
+    handled = []
+    bot = make_bot(handler_seconds, handled, workers)
+    start = time.perf_counter()
+    bot.process_new_updates(updates)
+    while len(handled) < len(updates):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    bot.worker_pool.close()
+    return elapsed, handled
+
+
+def run_pipeline(updates, handler_seconds, workers):
+    handled = []
+    bot = make_bot(handler_seconds, handled)
+    pipeline = update_pipeline.UpdatePipeline(bot, workers, max_pending=len(updates))
+
+    async def run():
+        await pipeline.start()
+        for update in updates:
+            await pipeline.submit(update)
+        await pipeline.drain()
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - start, handled
+
+
+def in_user_order(handled):
+    last = {}
+    for user_id, n in handled:
+        if last.get(user_id, -1) > n:
+            return False
+        last[user_id] = n
+    return True
+
+
+def main(users, updates_per_user, handler_ms, workers):
+    updates = make_updates(users, updates_per_user)
+    handler_seconds = handler_ms / 1000
+    print(f'{len(updates)} updates from {users} users, handler {handler_ms} ms')
+    runs = [('telebot threaded (2 workers)', lambda: run_telebot_threaded(updates, handler_seconds, 2)),
+            ('asyncio pipeline (2 workers)', lambda: run_pipeline(updates, handler_seconds, 2))]
+    if workers != 2:
+        runs += [(f'telebot threaded ({workers} workers)', lambda: run_telebot_threaded(updates, handler_seconds, workers)),
+                 (f'asyncio pipeline ({workers} workers)', lambda: run_pipeline(updates, handler_seconds, workers))]
+    for name, run in runs:
+        elapsed, handled = run()
+        print(f'{name:<36}{len(updates) / elapsed:>8.1f} updates/s, per-user order kept: {in_user_order(handled)}')
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    defaults = [20, 10, 20, 8]
+    main(*(args + defaults[len(args):]))
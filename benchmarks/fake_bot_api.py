@@ -0,0 +1,174 @@
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Stand-in for api.telegram.org: answers the Bot API methods the bot uses (getMe, getUpdates, sendMessage,
+# answerCallbackQuery, editMessageReplyMarkup, editMessageText, setWebhook, deleteWebhook) without network access.
+# Start it and point the bot at it with BOT_API_URL:
+#   python benchmarks/fake_bot_api.py --port 8081 --latency-ms 50 --rate-limit-every 20
+#   BOT_API_URL=http://127.0.0.1:8081 python hgbot.py
+# Updates for getUpdates are posted as JSON to /fake/updates (one update or a list, update_id is added if missing),
+# the calls made by the bot are listed by GET /fake/messages (?since=<seq>).
+# In-process benchmarks skip HTTP: apihelper._make_request = FakeBotApi(...).make_request
+
+BOT = {'id': 1, 'is_bot': True, 'first_name': 'hgbot', 'username': 'hgbot'}
+
+
+class FakeBotApi:
+    def __init__(self, latency_seconds=0, rate_limit_every=0, retry_after=1):
+        self.latency_seconds = latency_seconds
+        self.rate_limit_every = rate_limit_every  # every N-th sending call is answered with 429, 0 never
+        self.retry_after = retry_after
+        self.messages = []  # calls of the sending methods, in order
+        self.calls = {}  # method: count
+        self.rate_limited = 0
+        self._updates = []  # not yet confirmed by an offset
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._sending_calls = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def push_update(self, update):
+        with self._condition:
+            update = dict(update)
+            update.setdefault('update_id', next(self._update_ids))
+            self._updates.append(update)
+            self._condition.notify_all()
+        return update
+
+    def messages_since(self, seq):
+        with self._condition:
+            return self.messages[seq:]
+
+    # (HTTP status, Bot API answer)
+    def call(self, method_name, params):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._condition:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+        if method_name == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if method_name == 'getMe':
+            return 200, {'ok': True, 'result': BOT}
+        if method_name in ('setWebhook', 'deleteWebhook'):
+            return 200, {'ok': True, 'result': True}
+        if method_name not in ('sendMessage', 'answerCallbackQuery', 'editMessageReplyMarkup', 'editMessageText'):
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+
+        with self._condition:
+            if self.rate_limit_every and next(self._sending_calls) % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f'Too Many Requests: retry after {self.retry_after}',
+                             'parameters': {'retry_after': self.retry_after}}
+            entry = {'seq': len(self.messages), 't': time.time(), 'method': method_name, **params}
+            self.messages.append(entry)
+            if method_name == 'answerCallbackQuery':
+                return 200, {'ok': True, 'result': True}
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+        chat_id = int(params.get('chat_id', 0))
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()), 'from': BOT,
+                                            'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}}
+
+    # Replaces telebot's apihelper._make_request: the same answers without HTTP, errors raised like telebot does
+    def make_request(self, token, method_name, method='get', params=None, files=None):
+        from telebot.apihelper import ApiTelegramException
+        status, answer = self.call(method_name, params or {})
+        if not answer['ok']:
+            raise ApiTelegramException(method_name, None, answer)
+        return answer['result']
+
+    def total(self):
+        with self._condition:
+            return sum(self.calls.values())
+
+    # Long polling: waits up to the timeout for updates after offset
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self._condition:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+
+def create_server(api, host, port):
+    class FakeBotApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.handle_request()
+
+        def do_POST(self):
+            self.handle_request()
+
+        def handle_request(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if url.path == '/fake/updates' and self.command == 'POST':
+                updates = json.loads(body)
+                pushed = [api.push_update(u) for u in (updates if isinstance(updates, list) else [updates])]
+                self.send_json(200, {'ok': True, 'result': pushed})
+                return
+            if url.path == '/fake/messages':
+                self.send_json(200, {'ok': True, 'result': api.messages_since(int(params.get('since', 0)))})
+                return
+            # /bot<token>/<method>, telebot sends the parameters in the query string, other clients in the body
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+            if body:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body))
+                else:
+                    params.update(parse_qsl(body.decode()))
+            self.send_json(*api.call(parts[1], params))
+
+        def send_json(self, code, answer):
+            body = json.dumps(answer, ensure_ascii=False).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), FakeBotApiHandler)
+
+
+def start_server(api, host='127.0.0.1', port=0):
+    server = create_server(api, host, port)
+    threading.Thread(target=server.serve_forever, name='FakeBotApi', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay of every answer')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='answer every N-th sending call with 429 Too Many Requests (0: never)')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of the 429 answers, seconds')
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.latency_ms / 1000, args.rate_limit_every, args.retry_after)
+    server = create_server(api, args.host, args.port)
+    print(f'Fake Bot API on http://{args.host}:{args.port} (BOT_API_URL), '
+          f'updates: POST /fake/updates, calls: GET /fake/messages')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
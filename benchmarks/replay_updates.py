@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from sqlalchemy import create_engine
+
+from bench_e2e import percentile, wait_for_outbound
+from fake_bot_api import FakeBotApi
+
+from telebot import apihelper
+from telebot.types import Update
+
+import config
+import db_engine
+import update_pipeline
+import update_recorder
+
+# Replays a recording of RECORD_UPDATES_PATH through the real handlers of hgbot.py (with the update pipeline, like
+# python hgbot.py --async) against an in-process fake Bot API, at the recorded pace, N times faster or as fast as
+# possible. Reports the handler latency per state and the users whose replies differ from the recorded ones.
+# Usage: python benchmarks/replay_updates.py FILE [speed|max] [api_latency_ms]
+# The reports are saved to BENCH_DB_URL, which is required: use a copy of the production database, the recorded
+# usernames must be there.
+
+
+# Takes the replies of the handlers in place of the recorder of hgbot.py, by chat in the order they were made
+class ReplyLog:
+    def __init__(self):
+        self.replies = {}  # chat: [(method, hash)]
+        self._callback_chats = {}  # callback query id: chat
+        self._lock = threading.Lock()
+
+    def add_update(self, update):
+        if 'callback_query' in update:
+            self._callback_chats[update['callback_query']['id']] = update['callback_query']['from']['id']
+
+    def _add(self, chat, method, text):
+        with self._lock:
+            self.replies.setdefault(chat, []).append((method, update_recorder.hash_text(text)))
+
+    def record_reply(self, chat_id, method, text=None):
+        self._add(chat_id, method, text)
+
+    def record_callback_answer(self, call_id, text=None):
+        self._add(self._callback_chats.get(call_id), 'answerCallbackQuery', text)
+
+
+def read_recording(path):
+    updates, replies = [], {}  # [(t, update)], chat: [(method, hash)]
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'update' in entry:
+                updates.append((entry['t'], entry['update']))
+            else:
+                reply = entry['reply']
+                replies.setdefault(reply['chat'], []).append((reply['method'], reply['hash']))
+    return updates, replies
+
+
+def main(path, speed, api_latency_ms):
+    updates, recorded_replies = read_recording(path)
+    if not updates:
+        print(f'No updates in {path}')
+        return
+    db_engine.set_engine(create_engine(os.environ['BENCH_DB_URL']))
+
+    api = FakeBotApi(api_latency_ms / 1000)
+    apihelper._make_request = api.make_request
+
+    import hgbot
+    import outbound
+    hgbot.init()
+    replies = ReplyLog()
+    hgbot.RECORDER = replies
+
+    latencies = {}  # state: [seconds]
+    lock = threading.Lock()
+    process_new_updates = hgbot.bot.process_new_updates
+
+    def timed_process_new_updates(new_updates):
+        session = hgbot.SESSIONS.find(update_pipeline.get_update_user_id(new_updates[0]))
+        state = hgbot.STATE_NAMES[session.state] if session is not None and session.state is not None else 'none'
+        start = time.perf_counter()
+        try:
+            process_new_updates(new_updates)
+        finally:
+            with lock:
+                latencies.setdefault(state, []).append(time.perf_counter() - start)
+
+    hgbot.bot.process_new_updates = timed_process_new_updates
+
+    async def replay():
+        pipeline = update_pipeline.UpdatePipeline(hgbot.bot, config.update_workers, config.max_pending_updates)
+        await pipeline.start()
+        first_t, start = updates[0][0], time.perf_counter()
+        for t, raw_update in updates:
+            if speed:
+                delay = (t - first_t) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            replies.add_update(raw_update)
+            await pipeline.submit(Update.de_json(raw_update))
+        await pipeline.drain()
+        return pipeline
+
+    start = time.perf_counter()
+    pipeline = asyncio.run(replay())
+    handled = time.perf_counter() - start
+    wait_for_outbound(api, outbound)
+
+    recorded_span = updates[-1][0] - updates[0][0]
+    print(f'{len(updates)} updates recorded over {recorded_span:.1f}s, replayed '
+          f'{"as fast as possible" if not speed else f"at {speed:g}x"} in {handled:.2f}s '
+          f'({len(updates) / handled:.1f} updates/s), {pipeline.failed} failed')
+    print(f'{"state":<32}{"updates":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for state, values in sorted(latencies.items(), key=lambda item: -len(item[1])):
+        print(f'{state:<32}{len(values):>10}{percentile(values, 0.5) * 1000:>10.2f}'
+              f'{percentile(values, 0.99) * 1000:>10.2f}')
+    print(f'Telegram calls: {api.total()} ({", ".join(f"{m} {c}" for m, c in sorted(api.calls.items()))})')
+
+    # expected differences: the thank-you message is random and the replies depending on the current date (date
+    # buttons, reminders) differ when replayed on another day
+    chats = set(recorded_replies) | set(replies.replies)
+    divergent = [chat for chat in chats if recorded_replies.get(chat, []) != replies.replies.get(chat, [])]
+    print(f'replies differ for {len(divergent)} of {len(chats)} users')
+    for chat in divergent[:10]:
+        recorded, replayed = recorded_replies.get(chat, []), replies.replies.get(chat, [])
+        position = next((i for i, (a, b) in enumerate(zip(recorded, replayed)) if a != b),
+                        min(len(recorded), len(replayed)))
+        print(f'  {chat}: {len(recorded)} recorded, {len(replayed)} replayed, first difference at reply {position}: '
+              f'{recorded[position] if position < len(recorded) else None} != '
+              f'{replayed[position] if position < len(replayed) else None}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python benchmarks/replay_updates.py FILE [speed|max] [api_latency_ms]')
+    # the replayed reports are saved: never to the configured (production) database
+    if not os.environ.get('BENCH_DB_URL'):
+        sys.exit('BENCH_DB_URL is required: the database the replayed reports are saved to (a copy of production)')
+    speed_arg = sys.argv[2] if len(sys.argv) > 2 else '1'
+    main(sys.argv[1], None if speed_arg == 'max' else float(speed_arg),
+         int(sys.argv[3]) if len(sys.argv) > 3 else 20)
@@ -0,0 +1,50 @@
+import threading
+from loguru import logger
+
+
+# Runs one admin campaign at a time in a background thread, so that the handlers are not blocked while it sends.
+# The campaign is called with a threading.Event that is set when the campaign is cancelled.
+class CampaignRunner:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cancelled = None
+
+    def is_running(self):
+        with self._lock:
+            return self._thread is not None
+
+    # False if another campaign is running
+    def start(self, name, campaign):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._cancelled = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(name, campaign, self._cancelled),
+                                            name=f'Campaign-{name}', daemon=True)
+            self._thread.start()
+            return True
+
+    # False if no campaign is running
+    def cancel(self):
+        with self._lock:
+            if self._thread is None:
+                return False
+            self._cancelled.set()
+            return True
+
+    def _run(self, name, campaign, cancelled):
+        logger.info(f'Campaign {name} started')
+        try:
+            campaign(cancelled)
+            logger.info(f'Campaign {name} {"cancelled" if cancelled.is_set() else "finished"}')
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with self._lock:
+                self._thread = None
+                self._cancelled = None
+
+
+# Shared by the admin command and the weekly reminders of the reminder thread
+CAMPAIGNS = CampaignRunner()
@@ -9,15 +9,68 @@ db_password = os.environ['DB_PASSWORD']
 db_hostname = os.environ['DB_HOSTNAME']
 db_port = 6432
 db_name = os.environ['DB_NAME']
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+db_max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+db_pool_timeout = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+db_pool_recycle = int(os.environ.get('DB_POOL_RECYCLE', 30 * 60))
 
 # Telegram bot
 bot_token = os.environ['BOT_TOKEN']
+# Base URL of the Bot API, e.g. http://127.0.0.1:8081 for benchmarks/fake_bot_api.py (default api.telegram.org)
+bot_api_url = os.environ.get('BOT_API_URL')
 
 # Sentry
 sentry_url = os.environ['SENTRY_URL']
 
+# Outbound Bot API calls: Telegram allows about 30 messages per second per bot and about 1 per second per chat
+outbound_bot_rate = float(os.environ.get('OUTBOUND_BOT_RATE', 30))
+outbound_chat_rate = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+outbound_chat_burst = int(os.environ.get('OUTBOUND_CHAT_BURST', 3))
+outbound_workers = int(os.environ.get('OUTBOUND_WORKERS', 4))
+outbound_max_retries = int(os.environ.get('OUTBOUND_MAX_RETRIES', 3))
+# Longest wait for the result of a call (the retries after 429 answers included)
+outbound_result_timeout = float(os.environ.get('OUTBOUND_RESULT_TIMEOUT', 120))
+
 # Other
 min_age_to_send_reminder_in_days = 7
+key_value_check_interval_in_seconds = int(os.environ.get('KEY_VALUE_CHECK_INTERVAL_IN_SECONDS', 60))
+reminder_refresh_interval_in_seconds = int(os.environ.get('REMINDER_REFRESH_INTERVAL_IN_SECONDS', 15 * 60))
+roster_cache_ttl_in_seconds = int(os.environ.get('ROSTER_CACHE_TTL_IN_SECONDS', 10 * 60))
+
+# Update pipeline (python hgbot.py --async)
+update_workers = int(os.environ.get('UPDATE_WORKERS', 8))
+max_pending_updates = int(os.environ.get('MAX_PENDING_UPDATES', 1000))
+
+# Webhook mode (python hgbot.py --webhook): local HTTP receiver, usually behind a TLS-terminating reverse proxy
+webhook_host = os.environ.get('WEBHOOK_HOST', '127.0.0.1')
+webhook_port = int(os.environ.get('WEBHOOK_PORT', 8443))
+webhook_path = os.environ.get('WEBHOOK_PATH', '/telegram')
+webhook_secret = os.environ.get('WEBHOOK_SECRET')
+webhook_url = os.environ.get('WEBHOOK_URL')  # public URL registered with setWebhook, skipped if not set
+
+# Prometheus metrics endpoint (http://metrics_host:metrics_port/metrics), disabled if the port is 0
+metrics_host = os.environ.get('METRICS_HOST', '127.0.0.1')
+metrics_port = int(os.environ.get('METRICS_PORT', 9108))
+
+# Logging: the debug.log file is JSON lines if LOG_JSON is set, long messages are truncated and the lines logged
+# for each message sent are sampled (1 of LOG_SAMPLE_EVERY)
+log_level = os.environ.get('LOG_LEVEL', 'DEBUG')  # of the console output, debug.log always gets everything
+log_path = os.environ.get('LOG_PATH', 'debug.log')
+log_json = os.environ.get('LOG_JSON', '').lower() in ('1', 'true', 'yes')
+log_max_message_length = int(os.environ.get('LOG_MAX_MESSAGE_LENGTH', 500))
+log_sample_every = int(os.environ.get('LOG_SAMPLE_EVERY', 10))
+
+# Recording of the incoming updates for replay (benchmarks/replay_updates.py), disabled if the path is not set.
+# User ids are hashed with the salt: keep it secret to keep the recording anonymous. Without a salt a random one is
+# used, then the ids of a user differ between runs of the bot
+record_updates_path = os.environ.get('RECORD_UPDATES_PATH')
+record_updates_salt = os.environ.get('RECORD_UPDATES_SALT')
+
+# Report sessions (per-user state of a report in progress)
+session_ttl_in_seconds = int(os.environ.get('SESSION_TTL_IN_SECONDS', 6 * 60 * 60))
+max_sessions = int(os.environ.get('MAX_SESSIONS', 1000))
+session_backend = os.environ.get('SESSION_BACKEND', 'sqlite')  # memory, sqlite or postgres
+session_sqlite_path = os.environ.get('SESSION_SQLITE_PATH', 'sessions.sqlite3')
 
 # List of admins
 admins = os.environ['ADMINS']
@@ -1,4 +1,6 @@
-import pandas as pd
+import hashlib
+from sqlalchemy import Date, column, table, text
+import metrics
 
 VISITORS_TABLE = 'data_for_bot_visitors_view'
 USERNAMES_TABLE = 'data_for_bot_usernames'
@@ -8,12 +10,74 @@ USERS_TABLE = 'data_from_bot_users'
 MASTER_DATA_HISTORY_VIEW = 'master_data_history_view'
 KEY_VALUE_TABLE = 'key_value_storage'
 
-
+GUESTS_HISTORY_DAYS = 60
+
+# Column lists of the tables the bot writes to, no reflection needed for inserts.
+# Multi-row inserts go through executemany, which the psycopg2 dialect runs as execute_values batches.
+VISITS = table(VISITS_TABLE, column('name_leader'), column('id_hg'), column('name'), column('status'),
+               column('type_person'), column('reason'), column('date'), column('date_processed'))
+QUESTIONS = table(QUESTIONS_TABLE, column('name_leader'), column('id_hg'), column('date'), column('summary'),
+                  column('distributed_people_feedback'), column('testimony'), column('personal_meeting'))
+
+# Statements are built once with bound parameters: SQLAlchemy caches their compiled form
+# and values never end up in the SQL text.
+SELECT_USERNAMES_SQL = text(f'select id_hg, leader, usernames from {USERNAMES_TABLE}')
+SELECT_GROUP_MEMBERS_SQL = text(f'select name from {VISITORS_TABLE} where id_hg = :group_id order by name')
+SELECT_LEADER_GUESTS_SQL = text(
+    f"SELECT distinct(name) FROM {VISITS_TABLE} WHERE type_person='Гость' AND name_leader = :leader")
+SELECT_RECENT_GUESTS_SQL = text(
+    f"SELECT id_hg, name, max(date) as last_date FROM {VISITS_TABLE} WHERE type_person='Гость' AND date > :min_date "
+    "GROUP BY id_hg, name").columns(last_date=Date)
+UPSERT_USER_DATA_SQL = text(
+    f'INSERT INTO {USERS_TABLE} (telegram_username, telegram_uid) VALUES (:telegram_username, :telegram_uid) '
+    'ON CONFLICT (telegram_username) DO UPDATE SET telegram_uid = :telegram_uid, updated_ts = CURRENT_TIMESTAMP')
+# Open groups without a report since :min_date, with the telegram_uid of the leader joined in, so that reminders need
+# no lookup per group. The last visit is looked up per group: with an index on data_from_bot_visitors (id_hg, date)
+# the query does not read the history of the visits (see README.md for the DDL).
+SELECT_GROUPS_TO_REMIND_SQL = text(
+    "select l.id_hg, l.leader, l.max_date, l.leader_username, u.telegram_uid "
+    "from (select n.id_hg as id_hg, max(n.leader) as leader, "
+    f"(select max(v.date) from {VISITS_TABLE} v where v.id_hg = n.id_hg) as max_date, "
+    "replace(split_part(max(n.usernames), ',', 1), '@', '') as leader_username "
+    f"from {USERNAMES_TABLE} n "
+    f"where n.id_hg in (select m.name from {MASTER_DATA_HISTORY_VIEW} m "
+    "where m.status_of_hg = 'открыта' and m.vacation = 'false') "
+    "group by n.id_hg) l "
+    f"left join {USERS_TABLE} u on u.telegram_username = l.leader_username "
+    "where l.max_date is null or l.max_date < :min_date")
+SELECT_LEADER_UID_FOR_HG_SQL = text(
+    "select l.leader_username, u.telegram_uid "
+    "from (SELECT replace(split_part(max(usernames), ',', 1), '@', '') as leader_username "
+    f"from {USERNAMES_TABLE} where id_hg = :id_hg) l "
+    f"left join {USERS_TABLE} u on u.telegram_username = l.leader_username")
+SELECT_MASTER_DATA_FOR_TODAY_SQL = text(
+    "select g.id_hg as id_hg, max(m.status_of_hg) as status, max(m.type_age) as type_age, "
+    "max(m.weekday) as weekday, max(m.time_of_hg) as time_of_hg "
+    f"from {USERNAMES_TABLE} g "
+    f"inner join {MASTER_DATA_HISTORY_VIEW} m on g.id_hg = m.name "
+    "and m.status_of_hg = 'открыта' and m.vacation = 'false' "
+    "group by g.id_hg")
+SELECT_ALL_KEY_VALUES_SQL = text(
+    f'select key, value from {KEY_VALUE_TABLE} where is_enabled order by key, multivalue_seq_number')
+# Changes whenever any key, value, sequence number or enabled flag changes; returns a single row.
+# Each column is coalesced: a NULL would make the whole row NULL and string_agg would skip it.
+SELECT_KEY_VALUE_VERSION_SQL = text(
+    "select md5(coalesce(string_agg(coalesce(key::text, '') || ':' || coalesce(multivalue_seq_number::text, '') "
+    "|| ':' || coalesce(is_enabled::text, '') || ':' || coalesce(value::text, ''), "
+    f"chr(10) order by key, multivalue_seq_number, value), '')) from {KEY_VALUE_TABLE}")
+SELECT_KEY_VALUE_ROWS_SQL = text(
+    f'select key, multivalue_seq_number, is_enabled, value from {KEY_VALUE_TABLE} '
+    'order by key, multivalue_seq_number, value')
+
+
+# pandas is imported only by the functions returning DataFrames: it is slow to import and not needed by the handlers.
+# Every function is timed in hgbot_db_seconds.
+
+@metrics.timed(metrics.DB_SECONDS, 'function')
 def select_leader_usernames(engine):
-    usernames_df = pd.read_sql(f'select * from {USERNAMES_TABLE}', engine)
     users = {}
-    for i, group in usernames_df.iterrows():
-        for username in group.usernames.split(','):
+    for group in engine.execute(SELECT_USERNAMES_SQL):
+        for username in group['usernames'].split(','):
             username_no_handle = username.replace('@', '')
             if username_no_handle:
                 user_info = users.get(username_no_handle, {'user_id': None, 'username': username_no_handle, 'hgs': []})
@@ -23,71 +87,70 @@ def select_leader_usernames(engine):
     return users
 
 
+@metrics.timed(metrics.DB_SECONDS, 'function')
 def select_group_members(group_id, engine):
-    members_df = pd.read_sql(f"select name from {VISITORS_TABLE} where id_hg = '{group_id}'", engine)
-    members = members_df['name'].tolist()
-    return members
+    return [m[0] for m in engine.execute(SELECT_GROUP_MEMBERS_SQL, group_id=group_id)]
 
 
-def save_visitors_to_db(df, engine):
-    df.to_sql(VISITS_TABLE, engine, if_exists='append', index=None)
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def save_visitors_to_db(rows, engine):
+    if rows:
+        engine.execute(VISITS.insert(), rows)
 
 
-def save_questions_to_db(df, engine):
-    df.to_sql(QUESTIONS_TABLE, engine, if_exists='append', index=None)
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def save_questions_to_db(rows, engine):
+    if rows:
+        engine.execute(QUESTIONS.insert(), rows)
 
 
+@metrics.timed(metrics.DB_SECONDS, 'function')
 def get_leader_guests(leader, engine):
-    return [m[0] for m in list(engine.execute(
-        f"SELECT distinct(name) FROM {VISITS_TABLE} WHERE type_person='Гость' AND name_leader='{leader}'"))]
-
+    return [m[0] for m in engine.execute(SELECT_LEADER_GUESTS_SQL, leader=leader)]
 
-def get_group_guests(group_id, engine):
-    return [m[0] for m in list(engine.execute(
-        f"SELECT distinct(name) FROM {VISITS_TABLE} WHERE type_person='Гость' AND id_hg='{group_id}' AND date > current_date - interval '60 day'"))]
 
-
-def get_user_data(username, engine):
-    return list(engine.execute(
-        f"SELECT telegram_username, telegram_uid, user_state FROM {USERS_TABLE} WHERE telegram_username='{username}'"))
+# [(id_hg, name, last visit date)] of the guests of all groups seen after min_date
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def get_recent_guests(min_date, engine):
+    return [tuple(row) for row in engine.execute(SELECT_RECENT_GUESTS_SQL, min_date=min_date)]
 
 
+@metrics.timed(metrics.DB_SECONDS, 'function')
 def save_user_data(telegram_username, telegram_uid, engine):
-    engine.execute(
-        f"INSERT INTO {USERS_TABLE} (telegram_username, telegram_uid) VALUES ('{telegram_username}', {telegram_uid}) ON CONFLICT (telegram_username) DO UPDATE SET telegram_uid = {telegram_uid}, updated_ts = now()")
+    engine.execute(UPSERT_USER_DATA_SQL, telegram_username=telegram_username, telegram_uid=telegram_uid)
 
 
-def get_last_visits(engine):
-    sql = "select n.id_hg as id_hg, max(leader) as leader, max(v.date) as max_date, " \
-          "replace(split_part(max(n.usernames), ',', 1), '@', '') as leader_username " \
-          f"from {USERNAMES_TABLE} n " \
-          f"left join {VISITS_TABLE} v on n.id_hg = v.id_hg " \
-          "group by n.id_hg"
-    return pd.read_sql(sql, engine)
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def get_groups_to_remind(min_date, engine):
+    import pandas as pd
+    return pd.read_sql(SELECT_GROUPS_TO_REMIND_SQL, engine, params={'min_date': min_date})
 
 
-def get_leader_username_for_hg(id_hg, engine):
-    return list(engine.execute(
-        f"SELECT replace(split_part(max(usernames), ',', 1), '@', '') as leader_username from {USERNAMES_TABLE} where id_hg='{id_hg}'"))[
-        0][0]
+# (leader_username, telegram_uid), both None if the group is not found
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def get_leader_uid_for_hg(id_hg, engine):
+    return tuple(list(engine.execute(SELECT_LEADER_UID_FOR_HG_SQL, id_hg=id_hg))[0])
 
 
+@metrics.timed(metrics.DB_SECONDS, 'function')
 def get_master_data_for_today(engine):
-    sql = "select g.id_hg as id_hg, max(m.status_of_hg) as status, max(m.type_age) as type_age, max(m.weekday) as weekday, max(m.time_of_hg) as time_of_hg " \
-          f"from {USERNAMES_TABLE} g " \
-          f"inner join {MASTER_DATA_HISTORY_VIEW} m on g.id_hg = m.name " \
-          "and m.status_of_hg = 'открыта' and m.vacation = 'false' " \
-          "group by g.id_hg"
-    return pd.read_sql(sql, engine)
-
-
-def get_multi_key_value(key, engine):
-    sql = f"select value from {KEY_VALUE_TABLE} where key = '{key}' and is_enabled order by multivalue_seq_number"
-    return list(map(lambda x: x[0].replace('\\n', '\n'), engine.execute(sql)))
-
-
-def get_single_key_value(key, engine):
-    multi_key_value = get_multi_key_value(key, engine)
-    if len(multi_key_value) != 1:
-        raise ValueError(f"{len(multi_key_value)} enabled values found for key {key} (expected 1)")
-    return multi_key_value[0]
+    import pandas as pd
+    return pd.read_sql(SELECT_MASTER_DATA_FOR_TODAY_SQL, engine)
+
+
+# {key: [enabled values in sequence order]}
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def get_all_key_values(engine):
+    key_values = {}
+    for key, value in engine.execute(SELECT_ALL_KEY_VALUES_SQL):
+        key_values.setdefault(key, []).append(value.replace('\\n', '\n'))
+    return key_values
+
+
+@metrics.timed(metrics.DB_SECONDS, 'function')
+def get_key_value_version(engine):
+    if engine.dialect.name == 'postgresql':
+        return list(engine.execute(SELECT_KEY_VALUE_VERSION_SQL))[0][0]
+    # other databases (local benchmarks) have no string_agg: hash the rows here
+    rows = '\n'.join(':'.join(map(str, row)) for row in engine.execute(SELECT_KEY_VALUE_ROWS_SQL))
+    return hashlib.md5(rows.encode()).hexdigest()
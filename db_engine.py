@@ -0,0 +1,100 @@
+import threading
+import time
+import config
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+# QueuePool that counts checkouts, the checkouts that had to wait for a free connection and the time spent connecting.
+# The stats are updated from every thread checking out a connection: under stats_lock.
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.stats = {'checkouts': 0, 'waits': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                      'connects': 0, 'connect_seconds': 0.0, 'max_connect_seconds': 0.0, 'invalidated': 0}
+        self.stats_lock = threading.Lock()
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        pool.stats_lock = self.stats_lock
+        return pool
+
+    def stats_snapshot(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def _do_get(self):
+        exhausted = self.checkedout() >= self.size() + max(self._max_overflow, 0)
+        start = time.perf_counter()
+        connection = QueuePool._do_get(self)
+        wait = time.perf_counter() - start
+        with self.stats_lock:
+            self.stats['checkouts'] += 1
+            if exhausted:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += wait
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+        return connection
+
+    def _create_connection(self):
+        start = time.perf_counter()
+        connection = QueuePool._create_connection(self)
+        duration = time.perf_counter() - start
+        with self.stats_lock:
+            self.stats['connects'] += 1
+            self.stats['connect_seconds'] += duration
+            self.stats['max_connect_seconds'] = max(self.stats['max_connect_seconds'], duration)
+        return connection
+
+
+def create_instrumented_engine(url, **kwargs):
+    engine = create_engine(url, poolclass=InstrumentedQueuePool, **kwargs)
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        with engine.pool.stats_lock:
+            engine.pool.stats['invalidated'] += 1
+
+    return engine
+
+
+# One engine (and so one connection pool) for the whole process: the bot handlers and the reminders share it.
+# Pooled connections are kept (LIFO, long recycle, TCP keepalives) so that the TLS handshake with pgbouncer
+# happens once per connection instead of once per burst of queries; pre-ping replaces connections dropped
+# by pgbouncer before a handler gets them.
+def get_engine():
+    global _ENGINE
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = create_instrumented_engine(
+                    f'postgresql://{config.db_user}:{config.db_password}@{config.db_hostname}:{config.db_port}/{config.db_name}?sslmode=require',
+                    pool_size=config.db_pool_size,
+                    max_overflow=config.db_max_overflow,
+                    pool_timeout=config.db_pool_timeout,
+                    pool_recycle=config.db_pool_recycle,
+                    pool_pre_ping=True,
+                    pool_use_lifo=True,
+                    connect_args={'keepalives': 1, 'keepalives_idle': 60, 'keepalives_interval': 10,
+                                  'keepalives_count': 5})
+    return _ENGINE
+
+
+# Replaces the shared engine (e.g. with a local database in the benchmarks).
+# Must be called before importing the modules that keep the engine in a global (hgbot, send_reminders).
+def set_engine(engine):
+    global _ENGINE
+    _ENGINE = engine
+
+
+def pool_stats(engine=None):
+    pool = (engine or get_engine()).pool
+    stats = pool.stats_snapshot() if isinstance(pool, InstrumentedQueuePool) else {}
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow(),
+                      'checked_in': pool.checkedin()})
+    return stats
@@ -0,0 +1,59 @@
+import threading
+from datetime import date, timedelta
+
+
+# Guests seen in each group over the last days_to_keep days, for the guest keyboard: {id_hg: {name: last visit date}}.
+# Loaded with one query on first use (and again after invalidate), then kept up to date with the guests saved by
+# the bot. A guest is dropped once the last visit is older than days_to_keep.
+class RecentGuestIndex:
+    def __init__(self, loader, days_to_keep):
+        self._loader = loader  # min_date: [(id_hg, name, last visit date)] of the guests seen after min_date
+        self.days_to_keep = days_to_keep
+        self._groups = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def _min_date(self):
+        return date.today() - timedelta(days=self.days_to_keep)
+
+    # Called with the lock held: the handlers asking for guests during the load wait for it
+    def _warm(self):
+        if self._groups is not None:
+            return
+        groups = {}
+        for id_hg, name, last_date in self._loader(self._min_date()):
+            guests = groups.setdefault(id_hg, {})
+            guests[name] = max(last_date, guests.get(name, last_date))
+        self._groups = groups
+        self.loads += 1
+
+    def get(self, group_id):
+        min_date = self._min_date()
+        with self._lock:
+            self._warm()
+            self.hits += 1
+            guests = self._groups.get(group_id, {})
+            for name in [name for name, last_date in guests.items() if last_date <= min_date]:
+                del guests[name]
+            return sorted(guests)
+
+    def add(self, group_id, names, visit_date):
+        if visit_date <= self._min_date():
+            return
+        with self._lock:
+            if self._groups is None:
+                return  # the next load reads them from the database
+            guests = self._groups.setdefault(group_id, {})
+            for name in names:
+                guests[name] = max(visit_date, guests.get(name, visit_date))
+
+    def invalidate(self):
+        with self._lock:
+            self._groups = None
+
+    def stats(self):
+        with self._lock:
+            groups = self._groups or {}
+            return {'groups': len(groups), 'guests': sum(len(guests) for guests in groups.values()),
+                    'hits': self.hits, 'loads': self.loads}
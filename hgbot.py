@@ -1,134 +1,207 @@
-import pandas as pd
-from collections import defaultdict
+import startup_profile
+import argparse
+import functools
 from datetime import datetime, timedelta
 import config
 import db_access
+import db_engine
+import guest_index
+import key_value_cache
+import markup_cache
+import metrics
+import outbound
 import send_reminders
 import reminder_thread
-import logging
+import auth_index
+import campaign_runner
+import report_session
+import roster_cache
+import session_store
+import update_pipeline
+import update_recorder
+import webhook_server
+import logging_setup
 from loguru import logger
-from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
-import babel.dates
 import random
+import threading
+import time
 
 
-class InterceptHandler(logging.Handler):
-    def emit(self, record):
-        # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
-
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
-
-        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+logging_setup.setup_logging()
+logger.add(metrics.count_error, format="{message}", level="ERROR")
 
-# Intercepting log messages from third-party libs (e.g. Telebot) that have level INFO (20) or higher
-logging.basicConfig(handlers=[InterceptHandler()], level=20)
-
-logger.add("debug.log", format="{time} {level: <8} [{thread.name: <16}] {message}", level="DEBUG", rotation="3 MB", compression="zip")
-
-# States from certain range. States are kept in memory, lost if bot if restarted!
-USER_STATES = defaultdict(int)
+# States from certain range. States are saved to the session store on each change and restored after restart
 SELECT_GROUP, DATE, MARK_VISITORS, GROUP_DID_NOT_GATHER_CONFIRM, GUESTS, HG_SUMMARY, HG_SUMMARY_CONFIRM, \
 TESTIMONIES, TESTIMONIES_INPUT, TESTIMONIES_CONFIRM, PREACHER, \
 DISTRIBUTED_PEOPLE, DISTRIBUTED_PEOPLE_INPUT, DISTRIBUTED_PEOPLE_CONFIRM, \
 PERSONAL_MEETING, PERSONAL_MEETING_INPUT, PERSONAL_MEETING_CONFIRM, FINISH_ALL = range(18)
-
-# For each user, the current group he is working on (one user can edit different groups)
-USER_CURRENT_GROUPS = defaultdict(int)
-
-MEMBERS = defaultdict(dict)
-VISITORS = defaultdict(dict)
-GUEST_VISITORS = defaultdict(list)
-ACTIVE_REASONS = defaultdict(None)
-DATES = defaultdict(None)
-SUMMARY = defaultdict(None)
-DISTRIBUTED_PEOPLE_FEEDBACK = defaultdict(None)
-TESTIMONY = defaultdict(None)
-PERSONAL_MEETINGS_FEEDBACK = defaultdict(None)
-
-THANK_YOU_MESSAGES = ['Спасибо тебе!']  # just in case if nothing found in the DB
-FEEDBACK_MESSAGE = ''
+# Names of the states in the metrics
+STATE_NAMES = ['SELECT_GROUP', 'DATE', 'MARK_VISITORS', 'GROUP_DID_NOT_GATHER_CONFIRM', 'GUESTS', 'HG_SUMMARY',
+               'HG_SUMMARY_CONFIRM', 'TESTIMONIES', 'TESTIMONIES_INPUT', 'TESTIMONIES_CONFIRM', 'PREACHER',
+               'DISTRIBUTED_PEOPLE', 'DISTRIBUTED_PEOPLE_INPUT', 'DISTRIBUTED_PEOPLE_CONFIRM',
+               'PERSONAL_MEETING', 'PERSONAL_MEETING_INPUT', 'PERSONAL_MEETING_CONFIRM', 'FINISH_ALL']
+
+# thank_you_message and feedback_message are read from key_value_storage (KEY_VALUES)
+DEFAULT_THANK_YOU_MESSAGES = ['Спасибо тебе!']  # just in case if nothing found in the DB
+KEY_VALUES = key_value_cache.KEY_VALUES
 DATA_TOO_OLD_MESSAGE = 'К сожалению, данные устарели 😔 Пожалуйста, заполните отчет с начала.'
 DATA_TOO_OLD_MESSAGE_SHORT = 'Пожалуйста, заполните отчет с начала'
 ADMINS_USERNAME = config.admins.split(",")
 
-ENGINE = create_engine(f'postgresql://{config.db_user}:{config.db_password}@{config.db_hostname}:{config.db_port}/{config.db_name}?sslmode=require')
+ENGINE = db_engine.get_engine()
+
+# For each user, the report in progress: state, current group (one user can edit different groups) and answers.
+# The session store is attached in main()
+SESSIONS = report_session.SessionRegistry(config.session_ttl_in_seconds, config.max_sessions)
+
+REMINDERS = reminder_thread.ReminderThread()
+
+# Members of each group, shared by all users reporting for the group
+ROSTERS = roster_cache.RosterCache(lambda group_id: db_access.select_group_members(group_id, ENGINE),
+                                   config.roster_cache_ttl_in_seconds)
+
+# Guests of the last GUESTS_HISTORY_DAYS of each group, for the guest keyboard
+RECENT_GUESTS = guest_index.RecentGuestIndex(lambda min_date: db_access.get_recent_guests(min_date, ENGINE),
+                                             db_access.GUESTS_HISTORY_DAYS)
+
+# Serialized keyboards: static menus and the attendance keyboard of each group (per roster version)
+MARKUPS = markup_cache.MarkupCache()
 
 import telebot
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 
+if config.bot_api_url:
+    telebot.apihelper.API_URL = config.bot_api_url.rstrip('/') + '/bot{0}/{1}'
 bot = telebot.TeleBot(config.bot_token)
 
 import sentry_sdk
-
-sentry_sdk.init(config.sentry_url)
 from sentry_sdk import capture_exception
 
-# {username: {'group_id': , 'leader': , 'username': 'uid': (after first reaction from tg)}}
-USERS = {}
-USER_ID_MAP = {}  # user_id: username
+# users by username and by telegram id: {username: {'hgs': [{'group_id': , 'leader': }], 'username': , 'user_id': (after first reaction from tg)}}
+AUTH = auth_index.AuthIndex({}, ADMINS_USERNAME)
 GROUP_ICONS = ['🍏', '🍒', '🍉', '🍍', '🥥', '🍑', '🍇', '🫑', '🥝', '🍋']
 
+# Members on one page of the attendance keyboard (3 buttons each)
+ATTENDANCE_PAGE_SIZE = 8
+
+# Bot API calls made while marking attendance (outbound.DISPATCHER tally), summed over the finished attendance steps
+ATTENDANCE_CALLS = {'reports': 0, 'calls': 0}
+ATTENDANCE_CALLS_LOCK = threading.Lock()
+
+# The status message of a reminder campaign is edited at most this often
+CAMPAIGN_PROGRESS_INTERVAL_IN_SECONDS = 3
+
 
 # ================INITIALIZATION================
 
 def init():
-    global USERS, THANK_YOU_MESSAGES, FEEDBACK_MESSAGE
+    global AUTH
 
     logger.info('Init started')
-    USERS = db_access.select_leader_usernames(ENGINE)
-    logger.debug(f"Got {len(USERS)} users from DB")
-    THANK_YOU_MESSAGES = db_access.get_multi_key_value('thank_you_message', ENGINE)
-    FEEDBACK_MESSAGE = db_access.get_single_key_value('feedback_message', ENGINE)
-    logger.info('Init finished')
+    users = db_access.select_leader_usernames(ENGINE)
+    AUTH = auth_index.AuthIndex(users, ADMINS_USERNAME, previous=AUTH)
+    logger.debug(f"Got {len(users)} users from DB")
+    KEY_VALUES.refresh(force=True)
+    KEY_VALUES.get_single('feedback_message')  # fail fast if the message is not configured
+    if SESSIONS.store is not None:
+        SESSIONS.store.purge(config.session_ttl_in_seconds)
+    ROSTERS.invalidate()
+    RECENT_GUESTS.invalidate()
+    logger.info(f'Init finished, DB pool: {db_engine.pool_stats(ENGINE)}')
 
 
 # ================MESSAGE SENDING================
+# Calls are queued to the outbound dispatcher (rate limits, retries), the handlers do not wait for them
+
+# Set by main() if RECORD_UPDATES_PATH is configured: the replies are recorded next to the updates
+RECORDER = None
+
+
+def record_reply(chat_id, method, text=None):
+    if RECORDER is not None:
+        RECORDER.record_reply(chat_id, method, text)
+
+
+def record_callback_answer(call_id, text=None):
+    if RECORDER is not None:
+        RECORDER.record_callback_answer(call_id, text)
+
 
 def bot_send_message(user_id, text, reply_markup=None):
-    logger.info(f'[send_message: user_id = {user_id}] {text}')
-    bot.send_message(user_id, text, reply_markup=reply_markup)
+    logging_setup.log_sampled('send_message', f'[send_message: user_id = {user_id}] {text}')
+    record_reply(user_id, 'sendMessage', text)
+    return outbound.submit(bot, 'send_message', user_id, user_id, text, reply_markup=reply_markup)
+
+
+# If the previous edit of the message is still queued, it is sent once with the latest keyboard
+def bot_edit_message_reply_markup(user_id, message_id, reply_markup):
+    record_reply(user_id, 'editMessageReplyMarkup', reply_markup)
+    return outbound.submit(bot, 'edit_message_reply_markup', user_id, user_id, message_id, reply_markup=reply_markup,
+                           coalesce_key=('edit_message_reply_markup', user_id, message_id))
+
+
+# Queued edits of the same message are sent once with the latest text
+def bot_edit_message_text(chat_id, message_id, text):
+    record_reply(chat_id, 'editMessageText', text)
+    return outbound.submit(bot, 'edit_message_text', chat_id, text, chat_id, message_id,
+                           coalesce_key=('edit_message_text', chat_id, message_id))
 
 
 def bot_reply_to(message, text):
-    logger.info(f'[reply_to: user_id = {message.from_user.id}] {text}')
-    bot.reply_to(message, text)
+    logging_setup.log_sampled('reply_to', f'[reply_to: user_id = {message.from_user.id}] {text}')
+    record_reply(message.chat.id, 'sendMessage', text)
+    return outbound.submit(bot, 'reply_to', message.chat.id, message, text)
 
 
-def bot_answer_callback_query(call_id, call_data=None):
+# Answers are not ordered behind the calls to the chat, user_id only counts them in the chat's tally
+def bot_answer_callback_query(call_id, call_data=None, user_id=None):
     if call_data is not None:
-        logger.info(f'[answer_callback_query] {call_data}')
-    bot.answer_callback_query(call_id, call_data)
+        logging_setup.log_sampled('answer_callback_query', f'[answer_callback_query] {call_data}')
+    record_callback_answer(call_id, call_data)
+    return outbound.submit(bot, 'answer_callback_query', None, call_id, call_data, tally_chat_id=user_id)
 
 
 # ================HELPER METHODS================
 
+# Times the handler in hgbot_handler_seconds, labelled with the state of the user when the update arrived
+def timed_handler(handler):
+    @functools.wraps(handler)
+    def wrapper(update):
+        # the metrics label must not cost a store lookup: a session not in memory yet is counted as NEW
+        session = SESSIONS.peek(update.from_user.id)
+        state = STATE_NAMES[session.state] if session is not None else 'NEW'
+        with metrics.HANDLER_SECONDS.time(handler=handler.__name__, state=state):
+            return handler(update)
+    return wrapper
+
+
 def update_user_id(username, user_id):
-    USERS[username]['user_id'] = user_id
-    USER_ID_MAP[user_id] = username
+    AUTH.set_user_id(username, user_id)
+    session = SESSIONS.get(user_id)
+    session.username = username
+    SESSIONS.save(session)
     db_access.save_user_data(username, user_id, ENGINE)
 
 
-def update_user_current_group(username, group_id):
-    USER_CURRENT_GROUPS[username] = group_id
+def update_user_current_group(user_id, group_id):
+    SESSIONS.get(user_id).group_id = group_id
 
 
+# The result of the check is memoized on the message / callback query: filters and handlers check each update once
 def check_user_admin(message):
+    is_admin = getattr(message, '_hgbot_is_admin', None)
+    if is_admin is None:
+        is_admin = message._hgbot_is_admin = _check_user_admin(message)
+    return is_admin
+
+
+def _check_user_admin(message):
     try:
-        source_username = message.from_user.username
-        for username in ADMINS_USERNAME:
-            if source_username == username:
-                return True
-        
-        logger.warning(f'The user @{source_username} does not have access')
+        if AUTH.is_admin(message.from_user):
+            return True
+
+        logger.warning(f'The user @{message.from_user.username} does not have access')
         return False
     except Exception as e:
         logger.warning('Exception while checking user group!!')
@@ -136,15 +209,22 @@ def check_user_admin(message):
         logger.exception(e)
         return False
 
+
 def check_user_group(message):
+    user_info = getattr(message, '_hgbot_user_info', None)
+    if user_info is None:
+        user_info = message._hgbot_user_info = _check_user_group(message)
+    return user_info
+
+
+def _check_user_group(message):
     try:
-        source_username = message.from_user.username
-        for username, user_info in USERS.items():
-            if source_username == username:
-                return user_info
+        user_info = AUTH.find_user(message.from_user)
+        if user_info is not None:
+            return user_info
 
         bot_send_message(message.from_user.id, 'Привет! К сожалению, у тебя нет доступа')
-        logger.warning(f'The user @{source_username} does not have access')
+        logger.warning(f'The user @{message.from_user.username} does not have access')
         return False
     except Exception as e:
         logger.warning('Exception while checking user group!!')
@@ -153,30 +233,17 @@ def check_user_group(message):
         return False
 
 
-def get_leader_members(username):
-    group_id = USER_CURRENT_GROUPS[username]
-    #if group_id in MEMBERS:
-    #   return MEMBERS[group_id]
-    members = db_access.select_group_members(group_id, ENGINE)
-    MEMBERS[group_id] = members
-    return members
-
-
 def get_members(group_id):
-    #if group_id in MEMBERS:
-    #    return MEMBERS[group_id]
-    members = db_access.select_group_members(group_id, ENGINE)
-    MEMBERS[group_id] = members
-    return members
+    return ROSTERS.get(group_id)
 
 
 def check_current_group_id(user_id):
-    return user_id in USER_ID_MAP
+    session = SESSIONS.find(user_id)
+    return session is not None and session.group_id is not None
 
 
 def get_current_group_id(user_id):
-    username = USER_ID_MAP[user_id]
-    return USER_CURRENT_GROUPS[username]
+    return SESSIONS.get(user_id).group_id
 
 
 def get_group_info(user_info, group_id):
@@ -195,31 +262,79 @@ def parse_date(text):
             return None
 
 def format_date(date):
+    import babel.dates
     return babel.dates.format_date(date, 'd MMMM yyyy г.', 'ru')
 
 
 def get_user_mode(user_id):
-    return USER_STATES[user_id]
+    return SESSIONS.get(user_id).state
 
 
 def set_user_mode(user_id, mode):
-    USER_STATES[user_id] = mode
+    session = SESSIONS.get(user_id)
+    session.state = mode
+    SESSIONS.save(session)
 
 
 # ================MENUS================
 
-def get_visit_markup(members):
+# Current page of the attendance keyboard of the report. Pass the roster version only if the session holds
+# the roster of that version: the blank pages are the same for every report of the group and are cached.
+def get_visit_markup(session, roster_version=None):
+    members = get_attendance_members(session)
+    page = session.attendance_page
+    if not session.visitors and roster_version is not None:
+        return MARKUPS.roster((session.group_id, page), roster_version, members,
+                              lambda members: build_visit_markup(members, page))
+    return build_visit_markup(members, page, session.visitors)
+
+
+# The status and the reason of the marked members are shown on their title buttons. The buttons refer to
+# the members by index, so callback_data stays far below the 64 bytes limit whatever the names are.
+def build_visit_markup(members, page=0, visitors=None):
+    visitors = visitors or {}
+    pages = get_attendance_pages(members)
     markup = InlineKeyboardMarkup()
-    for member in members:
-        markup.row(InlineKeyboardButton(member, callback_data='TITLE'))
-        markup.row(InlineKeyboardButton(f"✅", callback_data="{}: +".format(member)),
-                   InlineKeyboardButton(f"🚫", callback_data="{}: -".format(member)))
+    start = page * ATTENDANCE_PAGE_SIZE
+    for index in range(start, min(start + ATTENDANCE_PAGE_SIZE, len(members))):
+        member = members[index]
+        markup.row(InlineKeyboardButton(get_visitor_title(member, visitors.get(member)), callback_data='TITLE'))
+        markup.row(InlineKeyboardButton("✅", callback_data=f'MARK:{index}:+'),
+                   InlineKeyboardButton("🚫", callback_data=f'MARK:{index}:-'))
+    if pages > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton('◀️', callback_data=f'PAGE:{page - 1}'))
+        navigation.append(InlineKeyboardButton(f'{page + 1} / {pages}', callback_data='TITLE'))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton('▶️', callback_data=f'PAGE:{page + 1}'))
+        markup.row(*navigation)
+    markup.row(InlineKeyboardButton('✅ Остальные присутствовали', callback_data='ALL_PRESENT'))
     markup.row(InlineKeyboardButton('Подтвердить отметки', callback_data='REVIEW'))
     markup.row(InlineKeyboardButton('Группа не прошла', callback_data='GROUP_DID_NOT_GATHER'))
     #     markup.row(InlineKeyboardButton('Добавить гостя', callback_data='ADD_GUEST'))
     return markup
 
 
+def get_attendance_pages(members):
+    return max(1, (len(members) + ATTENDANCE_PAGE_SIZE - 1) // ATTENDANCE_PAGE_SIZE)
+
+
+# Sessions restored from before the paged keyboard have no roster snapshot
+def get_attendance_members(session):
+    if not session.attendance_members:
+        session.attendance_members = list(get_members(session.group_id))
+    return session.attendance_members
+
+
+def get_visitor_title(member, visit):
+    if visit is None:
+        return member
+    if visit['status'] == '+':
+        return f'{member} — ✅'
+    return f'{member} — 🚫 {visit.get("reason", "")}'.rstrip()
+
+
 def get_guests_markup(guests):
     markup = InlineKeyboardMarkup()
     for guest in guests:
@@ -230,12 +345,20 @@ def get_guests_markup(guests):
 
 
 def get_review_markup():
+    return MARKUPS.static('review', build_review_markup)
+
+
+def build_review_markup():
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton('Все верно', callback_data='COMPLETE_VISITORS'))
     return markup
 
 
 def get_dates_markup():
+    return MARKUPS.static('dates', build_dates_markup)
+
+
+def build_dates_markup():
     dates_menu = ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     dates_menu.row('⏪ Позавчера')
     dates_menu.row('◀️ Вчера')
@@ -253,18 +376,24 @@ def get_groups_markup(group_ids):
     return menu
 
 
-def get_reasons_markup():
-    reasons_menu = ReplyKeyboardMarkup(one_time_keyboard=True)
+# Replaces the attendance keyboard until the reason of the absence is chosen
+def get_reasons_inline_markup():
+    return MARKUPS.static('reasons_inline', build_reasons_inline_markup)
 
-    reasons_menu.row(REASONS['work'][1], REASONS['family'][1])
-    reasons_menu.row(REASONS['illness'][1], REASONS['church'][1])
-    reasons_menu.row(REASONS['vacation'][1], REASONS['forgot'][1])
-    reasons_menu.row(REASONS['unknown'][1], REASONS['delete'][1])
 
-    return reasons_menu
+def build_reasons_inline_markup():
+    markup = InlineKeyboardMarkup()
+    codes = list(REASONS)
+    for i in range(0, len(codes), 2):
+        markup.row(*[InlineKeyboardButton(REASONS[code][1], callback_data=f'REASON_{code}') for code in codes[i:i + 2]])
+    return markup
 
 
 def get_confirm_yes_no_markup():
+    return MARKUPS.static('confirm_yes_no', build_confirm_yes_no_markup)
+
+
+def build_confirm_yes_no_markup():
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton('Да, все верно', callback_data='YES'),
                InlineKeyboardButton('Нет, хочу исправить', callback_data='NO'))
@@ -272,12 +401,20 @@ def get_confirm_yes_no_markup():
 
 
 def get_distributed_people_markup():
+    return MARKUPS.static('distributed_people', build_distributed_people_markup)
+
+
+def build_distributed_people_markup():
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton('Рассказать', callback_data='YES'),
                InlineKeyboardButton('Нет', callback_data='NO'))
     return markup
 
 
+def get_remove_keyboard_markup():
+    return MARKUPS.static('remove_keyboard', ReplyKeyboardRemove)
+
+
 DATES = {'✔️ Сегодня': (lambda: datetime.now().date()),
          '◀️ Вчера': (lambda: datetime.now().date() - timedelta(days=1)),
          '⏪ Позавчера': (lambda: datetime.now().date() - timedelta(days=2))}
@@ -292,105 +429,102 @@ REASONS = {'work': ('Работа / Учеба', '💼 Работа / Учеба
            'unknown': ('Не удалось выяснить причину', '🤷 Не удалось выяснить причину'),
            'delete': ('Удалить человека', '🚫 Удалить человека')
            }
+REASON_CALLBACKS = {f'REASON_{code}': code for code in REASONS}
 
 
-def get_visitors_df(user_id):
-    df = pd.DataFrame([{
+def get_visitors_rows(user_id):
+    session = SESSIONS.get(user_id)
+    date_processed = datetime.now()
+    return [{
         'name_leader': values['leader'],
-        'id_hg': get_current_group_id(user_id),
+        'id_hg': session.group_id,
         'name': name,
         'status': values['status'],
         'type_person': 'Член',
-        'reason': values.get('reason', None)}
-        for name, values in VISITORS[user_id].items()])
-    df['date'] = DATES[user_id]
-    df['date_processed'] = datetime.now()
-    return df
+        'reason': values.get('reason', None),
+        'date': session.date,
+        'date_processed': date_processed}
+        for name, values in session.visitors.items()]
 
 
-def get_guests_df(user_id):
-    df = pd.DataFrame([{
+def get_guests_rows(user_id):
+    session = SESSIONS.get(user_id)
+    date_processed = datetime.now()
+    return [{
         'name_leader': guest['leader'],
-        'id_hg': get_current_group_id(user_id),
+        'id_hg': session.group_id,
         'name': guest['name'],
         'status': guest['status'],
-        'type_person': 'Гость'}
-        for guest in GUEST_VISITORS[user_id]])
-    df['date'] = DATES[user_id]
-    df['date_processed'] = datetime.now()
-    return df
+        'type_person': 'Гость',
+        'reason': None,
+        'date': session.date,
+        'date_processed': date_processed}
+        for guest in session.guest_visitors]
 
 
-def get_questions_df(user_id):
-    username = USER_ID_MAP[user_id]
-    user_info = USERS[username]
-    group_id = USER_CURRENT_GROUPS[username]
+def get_questions_rows(user_id):
+    session = SESSIONS.get(user_id)
+    user_info = AUTH.by_username[session.username]
+    group_id = session.group_id
     group_info = get_group_info(user_info, group_id)
 
-    df = pd.DataFrame([{
+    return [{
         'name_leader': group_info['leader'],
         'id_hg': group_id[:7],
-        'date': DATES[user_id],
-        'summary': SUMMARY.get(user_id),
-        'distributed_people_feedback': DISTRIBUTED_PEOPLE_FEEDBACK.get(user_id),
-        'testimony': TESTIMONY.get(user_id),
-        'personal_meeting': PERSONAL_MEETINGS_FEEDBACK.get(user_id)
-    }])
-    return df
+        'date': session.date,
+        'summary': session.summary,
+        'distributed_people_feedback': session.distributed_people_feedback,
+        'testimony': session.testimony,
+        'personal_meeting': session.personal_meetings_feedback
+    }]
 
 
 def add_guest_vist(user_id, leader, guest):
-    existing_guest_names = set(map(lambda x: x['name'], GUEST_VISITORS[user_id]))
+    guest_visitors = SESSIONS.get(user_id).guest_visitors
+    existing_guest_names = set(map(lambda x: x['name'], guest_visitors))
     if guest in existing_guest_names:
         logger.info(f'Guest {guest} has been already added')
     else:
-        GUEST_VISITORS[user_id].append({'status': '+', 'leader': leader, 'guest': True, 'name': guest})
+        guest_visitors.append({'status': '+', 'leader': leader, 'guest': True, 'name': guest})
+        SESSIONS.save(SESSIONS.get(user_id))
 
 
 def add_summary(user_id, group_info, summary):
-    SUMMARY[user_id] = summary
+    SESSIONS.get(user_id).summary = summary
 
 
 def add_distributed_people(user_id, feedback):
-    DISTRIBUTED_PEOPLE_FEEDBACK[user_id] = feedback
+    SESSIONS.get(user_id).distributed_people_feedback = feedback
 
 
 def add_testimonies(user_id, testimony):
-    TESTIMONY[user_id] = testimony
+    SESSIONS.get(user_id).testimony = testimony
 
 
 def add_personal_meetings_feedback(user_id, personal_meetings_feedback):
-    PERSONAL_MEETINGS_FEEDBACK[user_id] = personal_meetings_feedback
+    SESSIONS.get(user_id).personal_meetings_feedback = personal_meetings_feedback
 
 
+# Checked against the roster snapshot of the session: a reload of the roster during the report changes nothing
 def group_members_checked(user_id):
-    group_members = get_leader_members(USER_ID_MAP[user_id])
-    return len(VISITORS[user_id]) == len(group_members)
+    return not get_missing_group_members(user_id)
 
 
 def get_missing_group_members(user_id):
-    group_members = get_leader_members(USER_ID_MAP[user_id])
-    return [m for m in group_members if m not in VISITORS[user_id]]
+    session = SESSIONS.get(user_id)
+    return [m for m in get_attendance_members(session) if m not in session.visitors]
 
 
 def cleanup(user_id):
-    VISITORS[user_id] = {}
-    GUEST_VISITORS[user_id] = []
-    ACTIVE_REASONS[user_id] = None
-    DATES[user_id] = None
-    USER_CURRENT_GROUPS[user_id] = None
-    SUMMARY[user_id] = None
-    DISTRIBUTED_PEOPLE_FEEDBACK[user_id] = None
-    TESTIMONY[user_id] = None
-    PERSONAL_MEETINGS_FEEDBACK[user_id] = None
+    SESSIONS.get(user_id).reset()
     set_user_mode(user_id, DATE)
 
 
 # ================WORKING WITH BOT================
 
 def respond_select_date(bot, user_id, username, group_id):
-    update_user_current_group(username, group_id)
-    user_info = USERS[username]
+    update_user_current_group(user_id, group_id)
+    user_info = AUTH.by_username[username]
     group_info = get_group_info(user_info, group_id)
     # bot_reply_to(message, f'Привет! Ты — {group_info["leader"]}, лидер группы {group_info["group_id"]}.')
 
@@ -413,37 +547,48 @@ def respond_date_is_in_future(message):
     bot_reply_to(message, 'Нельзя указать дату в будущем, попробуйте ввести еще раз')
 
 
-def respond_mark_visits(user_id, visit_date, group_members):
-    visit_menu = get_visit_markup(group_members)
-    bot_send_message(user_id, f'Отметьте посещения за {format_date(visit_date)} (при присутствии нажми ✅, при отсутствии нажми 🚫 и выбери причину отсутствия). Если группа не состоялась, нажмите «Группа не прошла».', reply_markup=visit_menu)
+def respond_mark_visits(user_id, visit_date, group_id):
+    session = SESSIONS.get(user_id)
+    members, version = ROSTERS.get_versioned(group_id)
+    session.attendance_members = list(members)
+    session.attendance_page = 0
     set_user_mode(user_id, MARK_VISITORS)
+    outbound.DISPATCHER.start_tally(user_id)
+    visit_menu = get_visit_markup(session, version)
+    bot_send_message(user_id, f'Отметьте посещения за {format_date(visit_date)} (при присутствии нажми ✅, при отсутствии нажми 🚫 и выбери причину отсутствия). Если группа не состоялась, нажмите «Группа не прошла».', reply_markup=visit_menu)
+
+
+# Called by the outbound sender that made the last call of the attendance step
+def count_attendance_calls(members, calls):
+    with ATTENDANCE_CALLS_LOCK:
+        ATTENDANCE_CALLS['reports'] += 1
+        ATTENDANCE_CALLS['calls'] += calls
+    logger.info(f'Attendance of {members} members marked with {calls} Bot API calls')
 
 
 def respond_review(bot, leader, user_id, call_id):
     if group_members_checked(user_id):
-        df = get_visitors_df(user_id)
-        review_text = '\n'.join([f'{row["name"]}: {"✅" if row["status"] == "+" else "🚫"}'
-                                 for i, row in df.iterrows()])
+        rows = get_visitors_rows(user_id)
+        review_text = '\n'.join([f'{row["name"]}: {"✅" if row["status"] == "+" else "🚫"}' for row in rows])
         bot_send_message(user_id,
                          f'Все члены отмечены, но ещё есть возможность изменить ответы:\n\n{review_text}',
                          reply_markup=get_review_markup())
-        bot_answer_callback_query(call_id)
-    # bot.send_document(user_id, df)
+        bot_answer_callback_query(call_id, user_id=user_id)
     else:
         missing = get_missing_group_members(user_id)
-        bot_answer_callback_query(call_id, 'Ещё не все члены отмечены: ' + ", ".join(missing))
+        bot_answer_callback_query(call_id, 'Ещё не все члены отмечены: ' + ", ".join(missing), user_id=user_id)
 
 
 def respond_complete(bot, group_id, user_id, call_id):
-    logger.info('Getting the DF')
-    df = get_visitors_df(user_id)
-    logger.info('Saving the DF')
-    db_access.save_visitors_to_db(df, ENGINE)
+    rows = get_visitors_rows(user_id)
+    logger.info(f'Saving {len(rows)} visits')
+    db_access.save_visitors_to_db(rows, ENGINE)
     #     cleanup(user_id)
     logger.info('SAVED!')
-    bot_answer_callback_query(call_id, 'Все члены отмечены!')
+    bot_answer_callback_query(call_id, 'Все члены отмечены!', user_id=user_id)
+    outbound.DISPATCHER.end_tally(user_id, lambda calls: count_attendance_calls(len(rows), calls))
     set_user_mode(user_id, GUESTS)
-    guests = db_access.get_group_guests(group_id, ENGINE)
+    guests = RECENT_GUESTS.get(group_id)
     guests_markup = get_guests_markup(guests)
     bot_send_message(user_id,
                      'Переходим к добавлению гостей. Отправьте в отдельных сообщениях имена новых гостей или выберите повторно посетивших из списка. Затем нажмите «Завершить добавление гостей»',
@@ -451,23 +596,92 @@ def respond_complete(bot, group_id, user_id, call_id):
     bot_answer_callback_query(call_id)
 
 
-def respond_visitor_selection(bot, leader, user_id, call_id, call_data):
-    name = call_data.split(':')[0]
+# The attendance message is edited in place: the marks are shown on the keyboard and the hints in the answers
+# to the clicks, the reasons replace the keyboard until one is chosen
+def respond_visitor_selection(bot, leader, user_id, call):
+    session = SESSIONS.get(user_id)
+    name, status = get_marked_member(session, call.data)
+    if name is None:
+        bot_answer_callback_query(call.id, DATA_TOO_OLD_MESSAGE_SHORT, user_id=user_id)
+        return
     logger.info(f'Got them {name}')
-    if ': -' in call_data:
-        VISITORS[user_id][name] = {'status': '-', 'leader': leader}
-        bot_answer_callback_query(call_id, 'Укажите причину отсутствия')
-        reasons_menu = get_reasons_markup()
-        ACTIVE_REASONS[user_id] = name
-        bot_send_message(user_id, f'Укажите причину отсутствия {name}',
-                         reply_markup=reasons_menu)
+    if status == '-':
+        session.visitors[name] = {'status': '-', 'leader': leader}
+        session.active_reason = name
+        SESSIONS.save(session)
+        bot_answer_callback_query(call.id, f'Укажите причину отсутствия {name}', user_id=user_id)
+        bot_edit_message_reply_markup(user_id, call.message.message_id, get_reasons_inline_markup())
     else:
-        bot_answer_callback_query(call_id, call_data)
-        VISITORS[user_id][name] = {'status': '+', 'leader': leader}
-        if group_members_checked(user_id):
-            bot_send_message(user_id, f'Отлично! Теперь нажмите «Подтвердить отметки»')
-        else:
-            bot_send_message(user_id, f'{name}: ✅\nПродолжайте отмечать дальше.')
+        previous = session.visitors.get(name)
+        session.visitors[name] = {'status': '+', 'leader': leader}
+        SESSIONS.save(session)
+        bot_answer_callback_query(call.id, get_attendance_hint(user_id, f'{name}: ✅'), user_id=user_id)
+        if previous is None or previous['status'] != '+':
+            bot_edit_message_reply_markup(user_id, call.message.message_id, get_visit_markup(session))
+
+
+# MARK:<index in session.attendance_members>:<status>, keyboards sent before the paged one use <name>: <status>.
+# (None, status) if the button does not match the roster, e.g. a stale keyboard.
+def get_marked_member(session, call_data):
+    if not call_data.startswith('MARK:'):
+        name, _, status = call_data.rpartition(': ')
+        return name or None, status
+    try:
+        _, index, status = call_data.split(':')
+        index = int(index)
+    except ValueError:
+        return None, None
+    members = get_attendance_members(session)
+    if not 0 <= index < len(members):
+        return None, status
+    return members[index], status
+
+
+def respond_attendance_page(user_id, call):
+    session = SESSIONS.get(user_id)
+    try:
+        page = int(call.data.split(':')[1])
+    except (ValueError, IndexError):
+        bot_answer_callback_query(call.id, DATA_TOO_OLD_MESSAGE_SHORT, user_id=user_id)
+        return
+    page = max(0, min(page, get_attendance_pages(get_attendance_members(session)) - 1))
+    bot_answer_callback_query(call.id, user_id=user_id)
+    if page != session.attendance_page:
+        session.attendance_page = page
+        SESSIONS.save(session)
+        bot_edit_message_reply_markup(user_id, call.message.message_id, get_visit_markup(session))
+
+
+# Marks everyone who has no mark yet as present, the absences already marked are kept
+def respond_all_present(leader, user_id, call):
+    session = SESSIONS.get(user_id)
+    unmarked = [member for member in get_attendance_members(session) if member not in session.visitors]
+    for member in unmarked:
+        session.visitors[member] = {'status': '+', 'leader': leader}
+    SESSIONS.save(session)
+    bot_answer_callback_query(call.id, get_attendance_hint(user_id, f'Отмечено присутствующими: {len(unmarked)}'),
+                              user_id=user_id)
+    if unmarked:
+        bot_edit_message_reply_markup(user_id, call.message.message_id, get_visit_markup(session))
+
+
+def respond_reason_selection(user_id, call):
+    session = SESSIONS.get(user_id)
+    name = session.active_reason
+    if name not in session.visitors:
+        bot_answer_callback_query(call.id, DATA_TOO_OLD_MESSAGE_SHORT, user_id=user_id)
+        return
+    reason_for_db = REASONS[REASON_CALLBACKS[call.data]][0]
+    session.visitors[name]['reason'] = reason_for_db
+    SESSIONS.save(session)
+    bot_answer_callback_query(call.id, get_attendance_hint(user_id, f'{name}: {reason_for_db}'), user_id=user_id)
+    bot_edit_message_reply_markup(user_id, call.message.message_id, get_visit_markup(session))
+
+
+def get_attendance_hint(user_id, mark):
+    if group_members_checked(user_id):
+        return 'Отлично! Теперь нажмите «Подтвердить отметки»'
+    return mark
 
 
 def respond_confirm_did_not_gather(user_id, call_id):
@@ -480,7 +694,7 @@ def respond_confirm_did_not_gather(user_id, call_id):
 
 def respond_hg_summary(user_id, call_id):
     set_user_mode(user_id, HG_SUMMARY)
-    bot_send_message(user_id, 'Опишите, о чем была духовная часть (3–4 тезиса)', reply_markup=ReplyKeyboardRemove())
+    bot_send_message(user_id, 'Опишите, о чем была духовная часть (3–4 тезиса)', reply_markup=get_remove_keyboard_markup())
     bot_answer_callback_query(call_id)
 
 
@@ -548,43 +762,52 @@ def respond_confirm_personal_meetings_feedback(user_id):
 
 
 def get_thank_you_message():
-    return random.choice(THANK_YOU_MESSAGES) + '\n\n' + FEEDBACK_MESSAGE
+    thank_you_messages = KEY_VALUES.get_multi('thank_you_message') or DEFAULT_THANK_YOU_MESSAGES
+    try:
+        feedback_message = KEY_VALUES.get_single('feedback_message')
+    except ValueError as e:
+        logger.error(e)
+        feedback_message = ''
+    return random.choice(thank_you_messages) + '\n\n' + feedback_message
 
 
 def respond_finish(user_id):
     set_user_mode(user_id, FINISH_ALL)
-    bot_send_message(user_id, get_thank_you_message(), reply_markup=ReplyKeyboardRemove())
+    bot_send_message(user_id, get_thank_you_message(), reply_markup=get_remove_keyboard_markup())
 
 
 # Handles all clicks on inline buttons
 @bot.callback_query_handler(func=lambda call: True)
+@timed_handler
 def callback_query(call):
     try:
         user_id = call.from_user.id
         user_info = check_user_group(call)
-        user_mode = get_user_mode(user_id)
+        session = SESSIONS.get(user_id)
+        user_mode = session.state
         logger.info(f'[User {user_id} (@{user_info["username"]})] Button Click: {call.data}, user mode {user_mode}')
 
         if not check_current_group_id(user_id):
-            bot_answer_callback_query(call.id, DATA_TOO_OLD_MESSAGE_SHORT)
+            bot_answer_callback_query(call.id, DATA_TOO_OLD_MESSAGE_SHORT, user_id=user_id)
             return
-        group_id = get_current_group_id(user_id)
+        group_id = session.group_id
         group_info = get_group_info(user_info, group_id)
         leader = group_info['leader']
 
         if user_mode == GUESTS:
             if call.data == 'FINISH_GUESTS':
-                guests_df = get_guests_df(user_id)
-                db_access.save_visitors_to_db(guests_df, ENGINE)
-                guests_text = '\n'.join([row['name'] for i, row in guests_df.iterrows()])
+                guests_rows = get_guests_rows(user_id)
+                db_access.save_visitors_to_db(guests_rows, ENGINE)
+                RECENT_GUESTS.add(group_id, [row['name'] for row in guests_rows], session.date)
+                guests_text = '\n'.join([row['name'] for row in guests_rows])
                 if guests_text != '':
                     bot_answer_callback_query(call.id)
                     bot_send_message(user_id, f'Гости добавлены:\n\n{guests_text}',
-                                    reply_markup=ReplyKeyboardRemove())
+                                    reply_markup=get_remove_keyboard_markup())
                 else:
                     bot_answer_callback_query(call.id)
                     bot_send_message(user_id, f'Гостей не было',
-                                    reply_markup=ReplyKeyboardRemove())
+                                    reply_markup=get_remove_keyboard_markup())
                 respond_hg_summary(user_id, call.id)
                 # cleanup(user_id)
             elif call.data != 'TITLE' and call.data != 'COMPLETE_VISITORS':
@@ -595,7 +818,7 @@ def callback_query(call):
         # skip summary button click
         elif user_mode == HG_SUMMARY_CONFIRM:
             if call.data == 'YES':
-                logger.info(f'Confirmed hg summary: {SUMMARY[user_id]}')
+                logger.info(f'Confirmed hg summary: {session.summary}')
                 bot_answer_callback_query(call.id)
                 respond_testimonies(user_id)
             elif call.data == 'NO':
@@ -633,34 +856,34 @@ def callback_query(call):
                 bot_answer_callback_query(call.id)
                 respond_input_distributed_people(user_id)
             elif call.data == 'NO':
-                questions_df = get_questions_df(user_id)
-                db_access.save_questions_to_db(questions_df, ENGINE)
-                logger.info(f'Saved questions df: {questions_df}')
+                questions_rows = get_questions_rows(user_id)
+                db_access.save_questions_to_db(questions_rows, ENGINE)
+                logger.info(f'Saved questions: {questions_rows}')
                 bot_answer_callback_query(call.id)
                 respond_finish(user_id)
         elif user_mode == DISTRIBUTED_PEOPLE_CONFIRM:
             if call.data == 'YES':
-                questions_df = get_questions_df(user_id)
-                db_access.save_questions_to_db(questions_df, ENGINE)
-                logger.info(f'Saved questions df: {questions_df}')
+                questions_rows = get_questions_rows(user_id)
+                db_access.save_questions_to_db(questions_rows, ENGINE)
+                logger.info(f'Saved questions: {questions_rows}')
                 bot_answer_callback_query(call.id)
                 respond_finish(user_id)
             elif call.data == 'NO':
                 bot_answer_callback_query(call.id)
                 respond_input_distributed_people(user_id)
         elif user_mode == GROUP_DID_NOT_GATHER_CONFIRM:
-            group_members = get_members(group_id)
+            group_members = get_attendance_members(session)
             if call.data == 'YES':
                 bot_answer_callback_query(call.id)
                 for group_member in group_members:
-                    VISITORS[user_id][group_member] = {'status': '-', 'leader': leader, 'reason': 'Группа не прошла'}
-                df = get_visitors_df(user_id)
-                logger.info(f'Saving the DF with {len(group_members)} size')
-                db_access.save_visitors_to_db(df, ENGINE)
+                    session.visitors[group_member] = {'status': '-', 'leader': leader, 'reason': 'Группа не прошла'}
+                rows = get_visitors_rows(user_id)
+                logger.info(f'Saving {len(rows)} visits')
+                db_access.save_visitors_to_db(rows, ENGINE)
                 respond_finish(user_id)
             elif call.data == 'NO':
                 bot_answer_callback_query(call.id)
-                respond_mark_visits(user_id, DATES[user_id], group_members)
+                respond_mark_visits(user_id, session.date, group_id)
         else:
             if call.data == 'REVIEW':
                 # bot.edit_message(user_id, reply_markup=ReplyKeyboardRemove())
@@ -669,14 +892,20 @@ def callback_query(call):
                 respond_complete(bot, group_id, user_id, call.id)
             elif call.data == 'GROUP_DID_NOT_GATHER':
                 respond_confirm_did_not_gather(user_id, call.id)
+            elif call.data in REASON_CALLBACKS:
+                respond_reason_selection(user_id, call)
+            elif call.data.startswith('PAGE:'):
+                respond_attendance_page(user_id, call)
+            elif call.data == 'ALL_PRESENT':
+                respond_all_present(leader, user_id, call)
             # should not fall here if wrong user mode
             elif call.data != "TITLE":
-                respond_visitor_selection(bot, leader, user_id, call.id, call.data)
+                respond_visitor_selection(bot, leader, user_id, call)
     except IntegrityError as e:
         logger.error(e)
         bot_answer_callback_query(call.id, 'Произошла ошибка. Нам очень жаль 😔')
-        bot_send_message(user_id, f'👺 Данные для группы {group_id} за дату {format_date(DATES[user_id])} уже были внесены',
-                         reply_markup=ReplyKeyboardRemove())
+        bot_send_message(user_id, f'👺 Данные для группы {group_id} за дату {format_date(session.date)} уже были внесены',
+                         reply_markup=get_remove_keyboard_markup())
     except Exception as e:
         capture_exception(e)
         logger.exception(e)
@@ -685,6 +914,7 @@ def callback_query(call):
 
 # Starting point of bot
 @bot.message_handler(func=check_user_group, commands=['add', 'start'])
+@timed_handler
 def select_group(message):
     try:
         user_id = message.from_user.id
@@ -710,6 +940,7 @@ def select_group(message):
 
 
 @bot.message_handler(func=check_user_group, regexp='Группа: ')
+@timed_handler
 def select_date(message):
     try:
         user_id = message.from_user.id
@@ -732,40 +963,119 @@ def select_date(message):
         logger.exception(e)
 
 
+# Runs in the campaign thread: the progress is shown by editing one status message
+def run_reminder_campaign(chat_id, cancelled):
+    try:
+        status = bot_send_message(chat_id, 'Подготовка рассылки напоминаний...').result(
+            timeout=config.outbound_result_timeout)
+    except Exception as e:
+        # without the status message there is nothing to show the progress in: the campaign is not started
+        logger.exception(e)
+        bot_send_message(chat_id, 'Не удалось начать рассылку напоминаний, попробуйте ещё раз')
+        return
+    shown = {'text': status.text, 'at': time.monotonic()}
+
+    def show(text):
+        if text != shown['text']:
+            bot_edit_message_text(chat_id, status.message_id, text)
+            shown['text'], shown['at'] = text, time.monotonic()
+
+    def progress(report):
+        if time.monotonic() - shown['at'] >= CAMPAIGN_PROGRESS_INTERVAL_IN_SECONDS:
+            show(f'Рассылка напоминаний: отправлено {len(report.sent_to)} из {report.total}, '
+                 f'ошибок: {len(report.failed)}. Чтобы остановить, отправьте «Остановить рассылку»')
+
+    report = send_reminders.run_reminder_campaign(progress, cancelled)
+    show(f'Рассылка напоминаний {"остановлена" if report.cancelled else "завершена"}: отправлено '
+         f'{len(report.sent_to)} из {report.total}, ошибок: {len(report.failed)}, '
+         f'не запускали бота: {len(report.skipped)}')
+    bot_send_message(chat_id, f'Разосланы напоминания лидерам: ' + ', '.join(report.sent_to))
+    logger.info(f'Sent reminders to {len(report.sent_to)} leaders: {report}')
+
+
 @bot.message_handler(func=check_user_admin, regexp='Разослать напоминания')
+@timed_handler
 def process_reminders(message):
     try:
+        chat_id = message.chat.id
+        if not campaign_runner.CAMPAIGNS.start('reminders', lambda cancelled: run_reminder_campaign(chat_id, cancelled)):
+            bot_reply_to(message, 'Рассылка уже идёт. Чтобы остановить её, отправьте «Остановить рассылку»')
+            return
         logger.info('Starting reminders...')
-        df = send_reminders.get_users_for_reminder()
-        sent_to = send_reminders.process_reminders(df)
-        bot_reply_to(message, f'Разосланы напоминания лидерам: ' + ', '.join(sent_to))
-        logger.info(f'Sent reminders to {len(sent_to)} leaders')
+    except Exception as e:
+        logger.exception(e)
+
+@bot.message_handler(func=check_user_admin, regexp='Остановить рассылку')
+@timed_handler
+def cancel_reminders(message):
+    try:
+        if campaign_runner.CAMPAIGNS.cancel():
+            logger.info('Reminders cancelled')
+            bot_reply_to(message, 'Рассылка останавливается')
+        else:
+            bot_reply_to(message, 'Рассылка не идёт')
     except Exception as e:
         logger.exception(e)
 
 @bot.message_handler(func=check_user_admin, regexp='Обновить')
+@timed_handler
 def update_bot(message):
     try:
         logger.info('Fetching data from DB')
         init()
-        bot_reply_to(message, 'Данные из БД обновлены')
+        REMINDERS.request_refresh()
+        bot_reply_to(message, f'Данные из БД обновлены (версия шаблонов: {KEY_VALUES.version})')
+    except Exception as e:
+        logger.exception(e)
+
+@bot.message_handler(func=check_user_admin, regexp='Версия шаблонов')
+@timed_handler
+def show_key_value_version(message):
+    try:
+        KEY_VALUES.refresh()
+        bot_reply_to(message, f'Версия шаблонов: {KEY_VALUES.version}, загружена {KEY_VALUES.loaded_at:%d.%m.%Y %H:%M:%S}')
+    except Exception as e:
+        logger.exception(e)
+
+@bot.message_handler(func=check_user_admin, regexp='Расписание')
+@timed_handler
+def show_reminder_jobs(message):
+    try:
+        jobs = REMINDERS.upcoming_jobs(limit=20)
+        jobs_text = '\n'.join(f'{next_run:%d.%m %H:%M} {name}' + (f' ({id_hg})' if id_hg else '')
+                              for next_run, name, id_hg in jobs)
+        bot_reply_to(message, f'Ближайшие напоминания:\n\n{jobs_text}' if jobs else 'Напоминаний нет')
+    except Exception as e:
+        logger.exception(e)
+
+@bot.message_handler(func=check_user_admin, regexp='Сбросить кэш')
+@timed_handler
+def invalidate_rosters(message):
+    try:
+        stats = ROSTERS.stats()
+        ROSTERS.invalidate()
+        logger.info(f'Roster cache invalidated: {stats}, keyboards: {MARKUPS.stats()}')
+        bot_reply_to(message, f'Кэш составов групп сброшен (групп: {stats["groups"]}, попаданий: {stats["hits"]}, '
+                              f'промахов: {stats["misses"]}, запросов к БД: {stats["loads"]})')
     except Exception as e:
         logger.exception(e)
 
 @bot.message_handler(func=check_user_group)
+@timed_handler
 def handle_generic_messages(message):
     try:
         user_id = message.from_user.id
         user_info = check_user_group(message)
         username = user_info['username']
-        user_mode = get_user_mode(user_id)
+        session = SESSIONS.get(user_id)
+        user_mode = session.state
         logger.info(f'[User {user_id} (@{username})] Handling inbound message. State = {user_mode}')
         logger.debug(f'Inbound message: {message.text}')
 
         if not check_current_group_id(user_id):
             bot_send_message(user_id, DATA_TOO_OLD_MESSAGE)
             return
-        group_id = get_current_group_id(user_id)
+        group_id = session.group_id
         group_info = get_group_info(user_info, group_id)
         leader = group_info['leader']
 
@@ -777,21 +1087,21 @@ def handle_generic_messages(message):
                 if visit_date > datetime.now().date():
                     respond_date_is_in_future(message)
                 else:
-                    group_members = get_members(group_id)
-                    bot_send_message(user_id, f'Выбранная дата: {format_date(visit_date)}', reply_markup=ReplyKeyboardRemove())
-                    DATES[user_id] = visit_date
-                    respond_mark_visits(user_id, visit_date, group_members)
+                    bot_send_message(user_id, f'Выбранная дата: {format_date(visit_date)}', reply_markup=get_remove_keyboard_markup())
+                    session.date = visit_date
+                    respond_mark_visits(user_id, visit_date, group_id)
             else:
                 respond_invalid_date_format(message)
                 #select_date(message)
 
         elif user_mode == MARK_VISITORS:
             reason_for_db = list(filter(lambda reason: reason[1] == message.text, REASONS.values()))[0][0]
-            VISITORS[user_id][ACTIVE_REASONS[user_id]]['reason'] = reason_for_db
+            session.visitors[session.active_reason]['reason'] = reason_for_db
+            SESSIONS.save(session)
             if group_members_checked(user_id):
                 bot_send_message(user_id, f'Отлично! Теперь нажмите «Подтвердить отметки»')
             else:
-                bot.send_message(user_id, f'{ACTIVE_REASONS[user_id]}: {reason_for_db}\nПродолжайте отмечать дальше.')
+                bot_send_message(user_id, f'{session.active_reason}: {reason_for_db}\nПродолжайте отмечать дальше.')
         elif user_mode == GUESTS:
             if len(message.text) > 32:
                 respond_guest_name_too_long(message)
@@ -815,7 +1125,79 @@ def handle_generic_messages(message):
         logger.exception(e)
 
 
-init()
-reminder_thread = reminder_thread.ReminderThread()
-reminder_thread.start()
-bot.polling()
+startup_profile.mark('import hgbot')
+
+
+# Current state of the pool, the outbound queues and the caches for the metrics endpoint
+def collect_gauges():
+    gauges = [(f'hgbot_db_pool_{name}', {}, value) for name, value in db_engine.pool_stats(ENGINE).items()]
+    outbound_stats = outbound.DISPATCHER.stats()
+    gauges += [('hgbot_outbound_queue_depth', {'lane': lane}, depth)
+               for lane, depth in outbound_stats['queue_depth'].items()]
+    gauges += [('hgbot_outbound_sent_total', {'method': method}, count)
+               for method, count in outbound_stats['sent'].items()]
+    gauges += [(f'hgbot_outbound_{name}_total', {}, outbound_stats[name])
+               for name in ('failed', 'rate_limited', 'coalesced')]
+    gauges += [(f'hgbot_roster_cache_{name}', {}, value) for name, value in ROSTERS.stats().items()]
+    gauges += [(f'hgbot_markup_cache_{name}', {}, value) for name, value in MARKUPS.stats().items()]
+    gauges += [(f'hgbot_guest_index_{name}', {}, value) for name, value in RECENT_GUESTS.stats().items()]
+    gauges += [('hgbot_sessions', {}, len(SESSIONS)),
+               ('hgbot_attendance_reports_total', {}, ATTENDANCE_CALLS['reports']),
+               ('hgbot_attendance_calls_total', {}, ATTENDANCE_CALLS['calls'])]
+    return gauges
+
+
+def profile_startup():
+    with startup_profile.measure('lazy import: pandas'):
+        import pandas
+    with startup_profile.measure('lazy import: babel.dates'):
+        import babel.dates
+    with startup_profile.measure('first DB connection'):
+        ENGINE.connect().close()
+    with startup_profile.measure('init()'):
+        init()
+    print(startup_profile.report())
+
+
+def main():
+    global RECORDER
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time spent in each startup phase and exit without polling')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='handle updates of different users concurrently (asyncio pipeline)')
+    parser.add_argument('--webhook', action='store_true',
+                        help='receive updates with a local HTTP server instead of long polling (implies --async)')
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    with startup_profile.measure('sentry_sdk.init()'):
+        sentry_sdk.init(config.sentry_url)
+    with startup_profile.measure('session store'):
+        SESSIONS.store = session_store.create_session_store(config.session_backend, ENGINE, config.session_sqlite_path)
+    with startup_profile.measure('init()'):
+        init()
+    REMINDERS.start()
+    if config.metrics_port:
+        metrics.add_collector(collect_gauges)
+        metrics.start_server(config.metrics_host, config.metrics_port)
+    if config.record_updates_path:
+        RECORDER = update_recorder.UpdateRecorder(config.record_updates_path, config.record_updates_salt)
+        RECORDER.install()
+    logger.info(f'Started in {startup_profile.total():.2f}s: {startup_profile.TIMINGS}')
+    if args.webhook:
+        pipeline = update_pipeline.UpdatePipeline(bot, config.update_workers, config.max_pending_updates)
+        webhook_server.run_webhook(bot, pipeline, config.webhook_host, config.webhook_port, config.webhook_path,
+                                   config.webhook_secret, config.webhook_url, recorder=RECORDER)
+    elif args.use_async:
+        update_pipeline.run_polling(bot, config.update_workers, config.max_pending_updates)
+    else:
+        bot.polling()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import threading
+import time
+from datetime import datetime
+from loguru import logger
+import config
+import db_access
+import db_engine
+
+
+# In-memory snapshot of all enabled values of key_value_storage. Reads are served from memory; at most once per
+# check interval a reader runs the cheap version query and the snapshot is reloaded (one query) if it has changed.
+class KeyValueSnapshot:
+    def __init__(self, get_engine, check_interval_in_seconds):
+        self._get_engine = get_engine
+        self.check_interval_in_seconds = check_interval_in_seconds
+        self._values = {}
+        self.version = None
+        self.loaded_at = None
+        self._checked_at = None
+        self._refresh_lock = threading.Lock()
+
+    def get_multi(self, key):
+        self._check_version()
+        return list(self._values.get(key, []))
+
+    def get_single(self, key):
+        values = self.get_multi(key)
+        if len(values) != 1:
+            raise ValueError(f"{len(values)} enabled values found for key {key} (expected 1)")
+        return values[0]
+
+    def refresh(self, force=False):
+        with self._refresh_lock:
+            self._refresh(force)
+
+    def _check_version(self):
+        if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval_in_seconds:
+            return
+        # only one reader checks the version, the others keep using the current snapshot
+        if self._refresh_lock.acquire(blocking=self._checked_at is None):
+            try:
+                self._refresh(force=False)
+            except Exception as e:
+                if self._checked_at is None:
+                    raise
+                # keep serving the snapshot, the next check is after the interval as usual
+                self._checked_at = time.monotonic()
+                logger.exception(e)
+            finally:
+                self._refresh_lock.release()
+
+    def _refresh(self, force):
+        engine = self._get_engine()
+        version = db_access.get_key_value_version(engine)
+        self._checked_at = time.monotonic()
+        if force or version != self.version:
+            # swap the whole dict, readers never see a partially loaded snapshot
+            self._values = db_access.get_all_key_values(engine)
+            self.loaded_at = datetime.now()
+            logger.info(f'Loaded key_value_storage version {version} ({len(self._values)} keys)')
+            self.version = version
+
+
+KEY_VALUES = KeyValueSnapshot(db_engine.get_engine, config.key_value_check_interval_in_seconds)
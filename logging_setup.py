@@ -0,0 +1,55 @@
+import logging
+import sys
+import threading
+from loguru import logger
+import config
+
+FILE_FORMAT = '{time} {level: <8} [{thread.name: <16}] {message}'
+
+# Standard levels of the logging module by number, the others are passed to loguru as numbers
+LEVEL_NAMES = {logging.CRITICAL: 'CRITICAL', logging.ERROR: 'ERROR', logging.WARNING: 'WARNING',
+               logging.INFO: 'INFO', logging.DEBUG: 'DEBUG'}
+
+_sample_counts = {}
+_sample_lock = threading.Lock()
+
+
+# Forwards the records of third-party libs (e.g. Telebot) to loguru. The origin of the message is copied
+# from the logging record instead of being found by walking the stack.
+class InterceptHandler(logging.Handler):
+    def emit(self, record):
+        def set_origin(loguru_record):
+            loguru_record.update(name=record.name, module=record.module, function=record.funcName,
+                                 line=record.lineno)
+
+        level = LEVEL_NAMES.get(record.levelno, record.levelno)
+        logger.patch(set_origin).opt(exception=record.exc_info).log(level, record.getMessage())
+
+
+# Message bodies (user input, texts sent to users) are cut to log_max_message_length
+def truncate_message(record):
+    message = record['message']
+    if len(message) > config.log_max_message_length:
+        record['message'] = f'{message[:config.log_max_message_length]}… ({len(message)} chars)'
+
+
+# With enqueue the records are written, and the log file rotated and compressed, by the loguru worker thread:
+# the handlers only put the record in a queue
+def setup_logging():
+    logger.remove()
+    logger.configure(patcher=truncate_message)
+    logger.add(sys.stderr, level=config.log_level, enqueue=True)
+    logger.add(config.log_path, format=FILE_FORMAT, level='DEBUG', rotation='3 MB', compression='zip',
+               enqueue=True, serialize=config.log_json)
+
+    # Intercepting log messages from third-party libs that have level INFO (20) or higher
+    logging.basicConfig(handlers=[InterceptHandler()], level=logging.INFO)
+
+
+# High-volume lines (e.g. every message sent) are logged once per log_sample_every calls with the same key
+def log_sampled(key, message):
+    with _sample_lock:
+        count = _sample_counts[key] = _sample_counts.get(key, 0) + 1
+    if (count - 1) % config.log_sample_every == 0:
+        suffix = f' (#{count}, 1 of {config.log_sample_every} logged)' if config.log_sample_every > 1 else ''
+        logger.opt(depth=1).info(message + suffix)
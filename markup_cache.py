@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+
+# Keyboards serialized to JSON once and sent as is (TeleBot passes a str reply_markup through).
+# Static keyboards are built on first use, roster keyboards once per key (e.g. group and page) and roster version.
+class MarkupCache:
+    def __init__(self, max_rosters=1000):
+        self.max_rosters = max_rosters
+        self._static = {}  # name: markup json
+        self._rosters = OrderedDict()  # key: (roster version, markup json)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+
+    def static(self, name, build):
+        markup = self._static.get(name)
+        if markup is not None:
+            self.hits += 1
+            return markup
+        with self._lock:
+            markup = self._static.get(name)
+            if markup is None:
+                markup = self._static[name] = build().to_json()
+                self.builds += 1
+            return markup
+
+    def roster(self, key, version, members, build):
+        with self._lock:
+            entry = self._rosters.get(key)
+            if entry is not None and version is not None and entry[0] == version:
+                self._rosters.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        markup = build(members).to_json()
+        with self._lock:
+            self.builds += 1
+            # a roster without version (invalidated while loading) is not cached
+            if version is not None:
+                self._rosters[key] = (version, markup)
+                self._rosters.move_to_end(key)
+                while len(self._rosters) > self.max_rosters:
+                    self._rosters.popitem(last=False)
+        return markup
+
+    def clear(self):
+        with self._lock:
+            self._static.clear()
+            self._rosters.clear()
+
+    def stats(self):
+        return {'static': len(self._static), 'rosters': len(self._rosters), 'hits': self.hits, 'builds': self.builds}
@@ -0,0 +1,163 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+# Latencies from a cached lookup (~1 ms) to a slow Bot API call (~10 s)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    values = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                      for name, value in labels.items())
+    return '{' + values + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}  # label values: count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values):
+            lines.append(f'{self.name}{format_labels(dict(zip(self.label_names, key)))} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values: [count per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            value[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            value[1] += seconds
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, counts, total in sorted(values):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram('hgbot_handler_seconds', 'Time spent in the bot handlers', ('handler', 'state'))
+DB_SECONDS = Histogram('hgbot_db_seconds', 'Time spent in the db_access functions', ('function',))
+BOT_API_SECONDS = Histogram('hgbot_bot_api_seconds', 'Duration of the Bot API calls', ('method', 'outcome'))
+ERRORS = Counter('hgbot_errors_total', 'Errors logged', ('module', 'function'))
+REMINDERS_SENT = Counter('hgbot_reminders_total', 'Reminders sent to the leaders', ('kind', 'outcome'))
+
+METRICS = [HANDLER_SECONDS, DB_SECONDS, BOT_API_SECONDS, ERRORS, REMINDERS_SENT]
+
+# Functions returning the current values of gauges (pool, queues, caches) as [(name, labels, value)].
+# Values named *_total are cumulative and exposed as counters.
+COLLECTORS = []
+
+
+def add_collector(collector):
+    COLLECTORS.append(collector)
+
+
+def timed(histogram, label):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**{label: function.__name__}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# loguru sink: every error logged by the bot is counted
+def count_error(message):
+    record = message.record
+    ERRORS.inc(module=record['module'], function=record['function'])
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    samples = {}  # name: lines, the samples of a metric must follow its TYPE line
+    for collector in COLLECTORS:
+        try:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+        except Exception as e:
+            logger.warning(f'Metrics collector {collector.__name__} failed: {e}')
+    for name, name_lines in samples.items():
+        lines.append(f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}')
+        lines.extend(name_lines)
+    return '\n'.join(lines) + '\n'
+
+
+def create_server(host, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), MetricsHandler)
+
+
+def start_server(host, port):
+    server = create_server(host, port)
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
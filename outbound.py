@@ -0,0 +1,310 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from loguru import logger
+from telebot.apihelper import ApiTelegramException
+import config
+import metrics
+
+# Priority lanes: replies to users go ahead of reminder fan-out
+INTERACTIVE, BULK = 0, 1
+LANE_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def ready_in(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        return self.ready_in(now) == 0 and self.tokens >= self.capacity
+
+
+# Bot API calls made for the jobs submitted while the tally was open. Once it is closed, on_done gets the number
+# of calls when the last of its jobs has finished.
+class CallTally:
+    __slots__ = ('calls', 'pending', 'on_done')
+
+    def __init__(self):
+        self.calls = 0
+        self.pending = 0
+        self.on_done = None
+
+
+class OutboundJob:
+    __slots__ = ('bot', 'method_name', 'chat_id', 'args', 'kwargs', 'lane', 'seq', 'coalesce_key', 'future', 'enqueued',
+                 'retries', 'tally')
+
+    def __init__(self, bot, method_name, chat_id, args, kwargs, lane, seq, coalesce_key=None, tally=None):
+        self.bot = bot
+        self.method_name = method_name
+        self.chat_id = chat_id
+        self.tally = tally
+        self.args = args
+        self.kwargs = kwargs
+        self.lane = lane
+        self.seq = seq
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.retries = 0
+
+
+# All Bot API calls that send something go through one dispatcher. It keeps within Telegram limits with a token
+# bucket per bot and per chat, sends the interactive lane first and keeps the order of calls to the same chat
+# (the next call to a chat starts after the previous one has finished). A 429 answer is retried after retry_after.
+# Calls submitted with a coalesce_key replace the arguments of a queued call with the same key (e.g. several edits
+# of one keyboard while the chat is rate limited become one edit with the latest keyboard).
+# The Bot API calls made for a chat can be counted from start_tally to end_tally, retries included; calls that are
+# not ordered by chat (callback answers) are counted for their tally_chat_id.
+class OutboundDispatcher(threading.Thread):
+    def __init__(self, bot_rate, chat_rate, chat_burst, workers, max_retries):
+        threading.Thread.__init__(self)
+        self.name = 'OutboundDispatcher'
+        self.daemon = True
+        self.bot_rate = bot_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='OutboundSender')
+        # a job leaves the queues only when a sender is free: jobs waiting in the executor would not be ordered by lane
+        self._free_senders = threading.Semaphore(workers)
+        self._condition = threading.Condition()
+        self._seq = itertools.count()
+        self._ready = []  # (lane, seq, job)
+        self._delayed = []  # (not_before, seq, lane, job)
+        self._busy_chats = set()
+        self._parked = {}  # chat_id: [(lane, seq, job)] waiting for the call in flight to the chat
+        self._coalescing = {}  # coalesce_key: job that has not been started yet
+        self._tallies = {}  # chat_id: open CallTally
+        self._bot_buckets = {}
+        self._chat_buckets = {}
+        self.sent = {}  # method_name: count
+        self.failed = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+        self.latency = {lane: {'count': 0, 'sum': 0.0, 'max': 0.0} for lane in LANE_NAMES}
+
+    def submit(self, bot, method_name, chat_id, *args, lane=INTERACTIVE, coalesce_key=None, tally_chat_id=None,
+               **kwargs):
+        with self._condition:
+            if coalesce_key is not None:
+                queued = self._coalescing.get(coalesce_key)
+                if queued is not None:
+                    queued.args, queued.kwargs = args, kwargs
+                    self.coalesced += 1
+                    return queued.future
+            tally = self._tallies.get(chat_id if tally_chat_id is None else tally_chat_id)
+            if tally is not None:
+                tally.pending += 1
+            job = OutboundJob(bot, method_name, chat_id, args, kwargs, lane, next(self._seq), coalesce_key, tally)
+            if coalesce_key is not None:
+                self._coalescing[coalesce_key] = job
+            heapq.heappush(self._ready, (lane, job.seq, job))
+            self._condition.notify()
+        return job.future
+
+    def start_tally(self, chat_id):
+        with self._condition:
+            self._tallies.pop(chat_id, None)
+            if len(self._tallies) >= MAX_CHAT_BUCKETS:
+                del self._tallies[next(iter(self._tallies))]  # the oldest one, most likely abandoned
+            self._tallies[chat_id] = CallTally()
+
+    # on_done(calls) is called once the jobs submitted for the tally have finished, in the sender thread of the last
+    # one. False if no tally was started for the chat (e.g. before a restart).
+    def end_tally(self, chat_id, on_done):
+        with self._condition:
+            tally = self._tallies.pop(chat_id, None)
+            if tally is None:
+                return False
+            tally.on_done = on_done
+            done = tally.pending == 0
+        if done:
+            on_done(tally.calls)
+        return True
+
+    def queue_depth(self):
+        with self._condition:
+            depth = {name: 0 for name in LANE_NAMES.values()}
+            entries = [entry[2] for entry in self._ready] + [entry[3] for entry in self._delayed] + \
+                      [entry[2] for parked in self._parked.values() for entry in parked]
+            for job in entries:
+                depth[LANE_NAMES[job.lane]] += 1
+            return depth
+
+    def stats(self):
+        queue_depth = self.queue_depth()
+        with self._condition:
+            return {'queue_depth': queue_depth, 'sent': dict(self.sent), 'failed': self.failed,
+                    'rate_limited': self.rate_limited, 'coalesced': self.coalesced,
+                    'latency': {LANE_NAMES[lane]: dict(values) for lane, values in self.latency.items()}}
+
+    def run(self):
+        while True:
+            self._free_senders.acquire()
+            job = None
+            # the thread cannot be started again: an error is logged and the loop goes on
+            try:
+                with self._condition:
+                    job = self._next_job()
+                    if job is not None:
+                        if job.coalesce_key is not None and self._coalescing.get(job.coalesce_key) is job:
+                            del self._coalescing[job.coalesce_key]
+                        if job.chat_id is not None:
+                            self._busy_chats.add(job.chat_id)
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+            if job is None:
+                self._free_senders.release()
+                continue
+            try:
+                self._executor.submit(self._send, job)
+            except RuntimeError as e:
+                # the executor is shut down when the interpreter exits
+                self._free_senders.release()
+                job.future.set_exception(e)
+                return
+
+    # Called with the condition held. Waits until a job can be sent, returns None to re-check the queues.
+    def _next_job(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            not_before, seq, lane, job = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (lane, seq, job))
+
+        if not self._ready:
+            self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+            return None
+
+        lane, seq, job = self._ready[0]
+        bot_bucket = self._get_bucket(self._bot_buckets, job.bot.token, self.bot_rate, self.bot_rate)
+        bot_wait = bot_bucket.ready_in(now)
+        if bot_wait > 0:
+            self._condition.wait(bot_wait)
+            return None
+        heapq.heappop(self._ready)
+
+        if job.chat_id is not None:
+            if job.chat_id in self._busy_chats:
+                self._parked.setdefault(job.chat_id, []).append((lane, seq, job))
+                return None
+            chat_bucket = self._get_bucket(self._chat_buckets, job.chat_id, self.chat_rate, self.chat_burst)
+            chat_wait = chat_bucket.ready_in(now)
+            if chat_wait > 0:
+                heapq.heappush(self._delayed, (now + chat_wait, seq, lane, job))
+                return None
+            chat_bucket.take()
+        bot_bucket.take()
+        return job
+
+    def _get_bucket(self, buckets, key, rate, capacity):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                # the buckets of chats with a call in flight are needed by _finish
+                for idle_key in [k for k, b in buckets.items() if b.is_idle(now) and k not in self._busy_chats]:
+                    del buckets[idle_key]
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    def _send(self, job):
+        retry_after = None
+        outcome = 'error'
+        start = time.perf_counter()
+        if job.tally is not None:
+            with self._condition:
+                job.tally.calls += 1
+        try:
+            result = getattr(job.bot, job.method_name)(*job.args, **job.kwargs)
+            outcome = 'ok'
+            self._record_sent(job)
+            job.future.set_result(result)
+        except ApiTelegramException as e:
+            outcome = 'rate_limited' if e.error_code == 429 else 'error'
+            if e.error_code == 429 and job.retries < self.max_retries:
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                logger.warning(f'[{job.method_name}: chat_id = {job.chat_id}] Too many requests, retry after {retry_after}s')
+                with self._condition:
+                    self.rate_limited += 1
+            else:
+                self._record_failed(job, e)
+        except Exception as e:
+            self._record_failed(job, e)
+        finally:
+            metrics.BOT_API_SECONDS.observe(time.perf_counter() - start, method=job.method_name, outcome=outcome)
+            self._finish(job, retry_after)
+            self._free_senders.release()
+
+    def _finish(self, job, retry_after):
+        tally = None
+        with self._condition:
+            now = time.monotonic()
+            if retry_after is not None:
+                job.retries += 1
+                if job.chat_id is not None:
+                    bucket = self._get_bucket(self._chat_buckets, job.chat_id, self.chat_rate, self.chat_burst)
+                else:
+                    bucket = self._get_bucket(self._bot_buckets, job.bot.token, self.bot_rate, self.bot_rate)
+                bucket.paused_until = now + retry_after
+                # the original sequence number keeps the retried call ahead of later calls to the chat
+                heapq.heappush(self._ready, (job.lane, job.seq, job))
+            elif job.tally is not None:
+                job.tally.pending -= 1
+                if job.tally.pending == 0 and job.tally.on_done is not None:
+                    tally = job.tally
+            if job.chat_id is not None:
+                self._busy_chats.discard(job.chat_id)
+                for entry in self._parked.pop(job.chat_id, []):
+                    heapq.heappush(self._ready, entry)
+            self._condition.notify()
+        if tally is not None:
+            tally.on_done(tally.calls)
+
+    # Called from the sender threads
+    def _record_sent(self, job):
+        latency = time.monotonic() - job.enqueued
+        with self._condition:
+            self.sent[job.method_name] = self.sent.get(job.method_name, 0) + 1
+            lane_latency = self.latency[job.lane]
+            lane_latency['count'] += 1
+            lane_latency['sum'] += latency
+            lane_latency['max'] = max(lane_latency['max'], latency)
+
+    def _record_failed(self, job, e):
+        with self._condition:
+            self.failed += 1
+        logger.error(f'[{job.method_name}: chat_id = {job.chat_id}] {e}')
+        job.future.set_exception(e)
+
+
+DISPATCHER = OutboundDispatcher(config.outbound_bot_rate, config.outbound_chat_rate, config.outbound_chat_burst,
+                                config.outbound_workers, config.outbound_max_retries)
+_start_lock = threading.Lock()
+
+
+def submit(bot, method_name, chat_id, *args, lane=INTERACTIVE, coalesce_key=None, tally_chat_id=None, **kwargs):
+    if not DISPATCHER.is_alive():
+        with _start_lock:
+            if not DISPATCHER.is_alive():
+                DISPATCHER.start()
+    return DISPATCHER.submit(bot, method_name, chat_id, *args, lane=lane, coalesce_key=coalesce_key,
+                             tally_chat_id=tally_chat_id, **kwargs)
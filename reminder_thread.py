@@ -1,93 +1,203 @@
+import heapq
+import itertools
 import threading
+from datetime import datetime, timedelta
 from loguru import logger
-import schedule
-import time
+import campaign_runner
+import config
 import send_reminders
 import datetime_helper
 
+# Index of the day in the week, as returned by datetime.weekday()
+WEEKDAYS = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье']
 
+
+class ReminderJob:
+    __slots__ = ('name', 'id_hg', 'weekday', 'at', 'interval', 'callback', 'kwargs', 'next_run', 'cancelled')
+
+    # Runs every week on weekday at 'HH:MM' (local time of the machine), or every interval if it is given
+    def __init__(self, name, callback, weekday=None, at=None, interval=None, id_hg=None, **kwargs):
+        self.name = name
+        self.id_hg = id_hg
+        self.weekday = weekday
+        self.at = at
+        self.interval = interval
+        self.callback = callback
+        self.kwargs = kwargs
+        self.next_run = None
+        self.cancelled = False
+
+    def schedule_next(self, now):
+        if self.interval is not None:
+            self.next_run = now + self.interval
+            return
+        hours, minutes = map(int, self.at.split(':'))
+        next_run = now.replace(hour=hours, minute=minutes, second=0, microsecond=0) + \
+            timedelta(days=(self.weekday - now.weekday()) % 7)
+        if next_run <= now:
+            next_run += timedelta(days=7)
+        self.next_run = next_run
+
+    # The jobs of a group get the id_hg of the group
+    def run(self):
+        if self.id_hg is not None:
+            self.callback(id_hg=self.id_hg, **self.kwargs)
+        else:
+            self.callback(**self.kwargs)
+
+
+# Keeps the reminder jobs in a heap ordered by the next run and sleeps until the first one is due.
+# The jobs of the groups are diffed against the master data periodically or on request (request_refresh).
 class ReminderThread(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         self.name = 'ReminderThread'
         self.daemon = True
+        self._heap = []  # (next_run, seq, job)
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._groups = {}  # id_hg: ((weekday, time_of_hg), [jobs])
+        self._refresh_requested = False
 
     def run(self):
         logger.info('Reminder thread started')
         self.init_jobs()
 
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            with self._condition:
+                due_jobs = self._wait_for_due_jobs()
+                refresh_requested = self._refresh_requested
+                self._refresh_requested = False
+            if refresh_requested:
+                self.refresh_jobs()
+            for job in due_jobs:
+                # a failing job must not stop the thread, it runs again at its next time
+                try:
+                    job.run()
+                except Exception as e:
+                    logger.exception(e)
+                with self._condition:
+                    if not job.cancelled:
+                        self._push(job, datetime.now())
+
+    def _wait_for_due_jobs(self):
+        while True:
+            now = datetime.now()
+            due_jobs = []
+            while self._heap and (self._heap[0][2].cancelled or self._heap[0][0] <= now):
+                next_run, seq, job = heapq.heappop(self._heap)
+                if not job.cancelled:
+                    due_jobs.append(job)
+            if due_jobs or self._refresh_requested:
+                return due_jobs
+            self._condition.wait((self._heap[0][0] - now).total_seconds() if self._heap else None)
+
+    def _push(self, job, now):
+        job.schedule_next(now)
+        heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+        self._condition.notify()
+
+    def add_job(self, job):
+        with self._condition:
+            self._push(job, datetime.now())
 
     def init_jobs(self):
         # Init reminders for old hgs
-        schedule.every().monday.at('11:00').do(self.send_reminders_for_old_hgs).tag('send_reminders_for_old_hgs')
+        self.add_job(ReminderJob('send_reminders_for_old_hgs', self.send_reminders_for_old_hgs, weekday=0, at='11:00'))
+        # Pick up changes of the master data
+        self.add_job(ReminderJob('refresh_jobs', self.refresh_jobs,
+                                 interval=timedelta(seconds=config.reminder_refresh_interval_in_seconds)))
 
         # Init reminders for today's hgs
-        master_data_df = send_reminders.get_actual_master_data()
-        for i, row in master_data_df.iterrows():
-            weekday = row['weekday']
-            time_of_hg = str(row['time_of_hg'])
-            id_hg = row['id_hg']
-            self.try_init_reminder_for_today(weekday, time_of_hg, id_hg)
+        self.refresh_jobs()
+
+    def request_refresh(self):
+        with self._condition:
+            self._refresh_requested = True
+            self._condition.notify()
 
+    def refresh_jobs(self):
+        import pandas as pd
+        try:
+            master_data_df = send_reminders.get_actual_master_data()
+        except Exception as e:
+            logger.exception(e)
+            return
+        # missing values come as NaN, which never equals itself: the schedule would look changed on every refresh
+        schedules = {row.id_hg: (None if pd.isnull(row.weekday) else row.weekday,
+                                 None if pd.isnull(row.time_of_hg) else str(row.time_of_hg))
+                     for row in master_data_df.itertuples()}
+
+        added, moved, removed = 0, 0, 0
+        with self._condition:
+            for id_hg in [id_hg for id_hg in self._groups if id_hg not in schedules]:
+                self._cancel_group(id_hg)
+                removed += 1
+            for id_hg, schedule in schedules.items():
+                current = self._groups.get(id_hg)
+                if current is not None and current[0] == schedule:
+                    continue
+                if current is not None:
+                    self._cancel_group(id_hg)
+                    moved += 1
+                else:
+                    added += 1
+                self._groups[id_hg] = (schedule, self.try_init_reminder_for_today(schedule[0], schedule[1], id_hg))
+            self._compact()
+        logger.info(f'Reminder jobs refreshed: {added} groups added, {moved} moved, {removed} removed')
+
+    def _cancel_group(self, id_hg):
+        schedule, jobs = self._groups.pop(id_hg)
+        for job in jobs:
+            job.cancelled = True
+
+    def _compact(self):
+        live = [entry for entry in self._heap if not entry[2].cancelled]
+        if len(live) < len(self._heap) / 2:
+            heapq.heapify(live)
+            self._heap = live
+
+    # Returns the jobs created for the group
     def try_init_reminder_for_today(self, weekday, time_of_hg, id_hg):
         logger.info(f'Init reminders for hg {id_hg}: {weekday} {time_of_hg}')
         if time_of_hg is None or weekday is None:
-            return
+            return []
 
         time_before_hg = datetime_helper.get_reminder_before_hg_time_utc(time_of_hg)
         time_after_hg = datetime_helper.get_reminder_after_hg_time_utc(time_of_hg)
 
         if time_before_hg is None or time_after_hg is None:
-            return
+            return []
 
         logger.info(f'Calculated times in UTC: {time_before_hg} {time_after_hg}')
 
-        if weekday.lower() == 'понедельник':
-            schedule.every().sunday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                          time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().monday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'вторник':
-            schedule.every().monday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                          time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().tuesday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'среда':
-            schedule.every().tuesday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                           time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().wednesday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'четверг':
-            schedule.every().wednesday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                             time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().thursday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'пятница':
-            schedule.every().thursday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                            time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().friday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'суббота':
-            schedule.every().friday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                          time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().saturday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        elif weekday.lower() == 'воскресенье':
-            schedule.every().saturday.at(time_before_hg).do(self.send_reminders_before_hg, id_hg=id_hg,
-                                                            time_of_hg=time_of_hg).tag('send_reminders_before_hg')
-            schedule.every().sunday.at(time_after_hg).do(self.send_reminders_after_hg, id_hg=id_hg).tag(
-                'send_reminders_after_hg')
-        else:
+        if weekday.lower() not in WEEKDAYS:
             logger.warning(f'Unexpected weekday: {weekday}')
+            return []
+
+        # the reminder before hg is sent the day before
+        weekday_index = WEEKDAYS.index(weekday.lower())
+        jobs = [ReminderJob('send_reminders_before_hg', self.send_reminders_before_hg, weekday=(weekday_index - 1) % 7,
+                            at=time_before_hg, id_hg=id_hg, time_of_hg=time_of_hg),
+                ReminderJob('send_reminders_after_hg', self.send_reminders_after_hg, weekday=weekday_index,
+                            at=time_after_hg, id_hg=id_hg)]
+        now = datetime.now()
+        for job in jobs:
+            self._push(job, now)
+        return jobs
+
+    def upcoming_jobs(self, limit=None):
+        with self._condition:
+            jobs = sorted((entry for entry in self._heap if not entry[2].cancelled), key=lambda entry: entry[:2])
+        return [(next_run, job.name, job.id_hg) for next_run, seq, job in jobs[:limit]]
 
     def send_reminders_for_old_hgs(self):
         try:
             logger.info(f'Executing check_old_hgs')
-            df = send_reminders.get_users_for_reminder()
-            send_reminders.process_reminders(df)
+            campaign = lambda cancelled: send_reminders.run_reminder_campaign(cancelled=cancelled)
+            # the admin command runs the same campaign: retrying after it would remind the leaders twice
+            if not campaign_runner.CAMPAIGNS.start('reminders', campaign):
+                logger.warning('Reminders for old hgs skipped: the reminders campaign is already running')
         except Exception as e:
             logger.exception(e)
 
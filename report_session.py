@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from loguru import logger
+
+# Documents older than the TTL are deleted from the store at most this often, on save
+STORE_PURGE_INTERVAL_IN_SECONDS = 3600
+
+
+# State of the report a user is currently filling in. One object per user instead of a dict entry per field.
+class ReportSession:
+    __slots__ = ('user_id', 'username', 'state', 'group_id', 'date', 'visitors', 'guest_visitors', 'active_reason',
+                 'summary', 'testimony', 'distributed_people_feedback', 'personal_meetings_feedback',
+                 'attendance_members', 'attendance_page', 'last_access')
+
+    def __init__(self, user_id, state=0):
+        self.user_id = user_id
+        self.username = None
+        self.state = state
+        self.last_access = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        self.group_id = None
+        self.date = None
+        self.visitors = {}
+        self.guest_visitors = []
+        self.active_reason = None
+        self.summary = None
+        self.testimony = None
+        self.distributed_people_feedback = None
+        self.personal_meetings_feedback = None
+        self.attendance_members = []  # roster shown on the attendance keyboard, the buttons refer to it by index
+        self.attendance_page = 0
+
+    def to_dict(self):
+        return {
+            'username': self.username,
+            'state': self.state,
+            'group_id': self.group_id,
+            'date': self.date.isoformat() if self.date is not None else None,
+            'visitors': self.visitors,
+            'guest_visitors': self.guest_visitors,
+            'active_reason': self.active_reason,
+            'summary': self.summary,
+            'testimony': self.testimony,
+            'distributed_people_feedback': self.distributed_people_feedback,
+            'personal_meetings_feedback': self.personal_meetings_feedback,
+            'attendance_members': self.attendance_members,
+            'attendance_page': self.attendance_page,
+        }
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        session = cls(user_id, data['state'])
+        session.username = data['username']
+        session.group_id = data['group_id']
+        session.date = date.fromisoformat(data['date']) if data['date'] is not None else None
+        session.visitors = data['visitors']
+        session.guest_visitors = data['guest_visitors']
+        session.active_reason = data['active_reason']
+        session.summary = data['summary']
+        session.testimony = data['testimony']
+        session.distributed_people_feedback = data['distributed_people_feedback']
+        session.personal_meetings_feedback = data['personal_meetings_feedback']
+        session.attendance_members = data.get('attendance_members', [])
+        session.attendance_page = data.get('attendance_page', 0)
+        return session
+
+
+# Sessions ordered from least to most recently used: idle sessions are evicted from the front
+# once they exceed the TTL, the oldest ones are evicted when there are more than max_sessions.
+# Sessions missing in memory (e.g. after a restart) are restored from the store on first access.
+class SessionRegistry:
+    def __init__(self, ttl_in_seconds, max_sessions, store=None):
+        self.ttl_in_seconds = ttl_in_seconds
+        self.max_sessions = max_sessions
+        self.store = store
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.restored = 0
+        self._purged_at = time.monotonic()
+
+    def get(self, user_id):
+        session = self.find(user_id)
+        if session is None:
+            session = self._insert(ReportSession(user_id))
+        return session
+
+    def find(self, user_id):
+        with self._lock:
+            session = self._touch(user_id)
+        if session is None and self.store is not None:
+            data = self.store.load(user_id, self.ttl_in_seconds)
+            if data is not None:
+                session = self._insert(ReportSession.from_dict(user_id, data))
+                self.restored += 1
+        return session
+
+    # Only the sessions in memory: no store lookup, the session is not marked as used
+    def peek(self, user_id):
+        with self._lock:
+            return self._sessions.get(user_id)
+
+    def save(self, session):
+        if self.store is not None:
+            self.store.save(session.user_id, session.to_dict())
+            self._purge_store()
+
+    # The store keeps a document for every user who ever saved one: the expired ones are purged periodically
+    def _purge_store(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._purged_at < STORE_PURGE_INTERVAL_IN_SECONDS:
+                return
+            self._purged_at = now
+        try:
+            self.store.purge(self.ttl_in_seconds)
+        except Exception as e:
+            logger.exception(e)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        if self.store is not None:
+            self.store.delete(user_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _insert(self, session):
+        with self._lock:
+            # another thread may have created the session in the meantime
+            existing = self._touch(session.user_id)
+            if existing is not None:
+                return existing
+            self._sessions[session.user_id] = session
+            self._evict()
+            return session
+
+    def _touch(self, user_id):
+        now = time.monotonic()
+        self._evict(now)
+        session = self._sessions.get(user_id)
+        if session is not None:
+            session.last_access = now
+            self._sessions.move_to_end(user_id)
+        return session
+
+    def _evict(self, now=None):
+        now = now if now is not None else time.monotonic()
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_access <= self.ttl_in_seconds:
+                break
+            del self._sessions[user_id]
+            self.evicted += 1
@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Group members by group id. Concurrent misses for the same group share one query (single flight).
+# Each stored roster gets a new version, so that things built from a roster (keyboards) can be cached per version.
+class RosterCache:
+    def __init__(self, loader, ttl_in_seconds):
+        self._loader = loader
+        self.ttl_in_seconds = ttl_in_seconds
+        self._entries = {}  # group_id: (members, loaded_at, version)
+        self._loading = {}  # group_id: Future of (members, version)
+        # a load is stored only if neither its group nor the whole cache was invalidated meanwhile
+        self._generations = {}  # group_id: number of invalidations of the group
+        self._generation = 0  # number of invalidations of the whole cache
+        self._version = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def get(self, group_id):
+        return self.get_versioned(group_id)[0]
+
+    # Returns (members, version). The version is None if the roster was invalidated while loading.
+    def get_versioned(self, group_id):
+        with self._lock:
+            entry = self._entries.get(group_id)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl_in_seconds:
+                self.hits += 1
+                return entry[0], entry[2]
+            self.misses += 1
+            pending = self._loading.get(group_id)
+            if pending is not None:
+                owner = False
+            else:
+                owner = True
+                pending = self._loading[group_id] = Future()
+                generation = (self._generation, self._generations.get(group_id, 0))
+
+        if not owner:
+            return pending.result()
+
+        try:
+            members = tuple(self._loader(group_id))
+        except Exception as e:
+            with self._lock:
+                self._forget_load(group_id, pending)
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            self.loads += 1
+            self._forget_load(group_id, pending)
+            # do not store a roster that was invalidated while loading
+            if generation == (self._generation, self._generations.get(group_id, 0)):
+                self._version += 1
+                version = self._version
+                self._entries[group_id] = (members, time.monotonic(), version)
+            else:
+                version = None
+        pending.set_result((members, version))
+        return members, version
+
+    # Called with the lock held. A load dropped by invalidate is no longer in _loading.
+    def _forget_load(self, group_id, pending):
+        if self._loading.get(group_id) is pending:
+            del self._loading[group_id]
+
+    # The loads in progress are dropped too: the next get() starts a new one
+    def invalidate(self, group_id=None):
+        with self._lock:
+            if group_id is None:
+                self._generation += 1
+                self._entries.clear()
+                self._loading.clear()
+            else:
+                self._generations[group_id] = self._generations.get(group_id, 0) + 1
+                self._entries.pop(group_id, None)
+                self._loading.pop(group_id, None)
+
+    def stats(self):
+        return {'groups': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'loads': self.loads}
@@ -1,16 +1,22 @@
-import pandas as pd
+import concurrent.futures
 import config
 import db_access
+import db_engine
+import key_value_cache
+import metrics
 from datetime import date, timedelta
 from loguru import logger
-from sqlalchemy import create_engine
-import babel.dates
+import outbound
 import random
 import telebot
+import time
+from collections import deque
+from contextlib import contextmanager
 
-ENGINE = create_engine(
-    f'postgresql://{config.db_user}:{config.db_password}@{config.db_hostname}:{config.db_port}/{config.db_name}?sslmode=require')
+ENGINE = db_engine.get_engine()
 
+if config.bot_api_url:
+    telebot.apihelper.API_URL = config.bot_api_url.rstrip('/') + '/bot{0}/{1}'
 bot = telebot.TeleBot(config.bot_token)
 
 
@@ -19,70 +25,139 @@ def get_actual_master_data():
     return df
 
 
+# Open groups without a report since the start of the previous week
 def get_users_for_reminder():
-    df_last_visits = db_access.get_last_visits(ENGINE)
-    df_master_data = get_actual_master_data()
-    df_all = pd.merge(df_last_visits, df_master_data, on='id_hg')
-    to_remind = df_all[(df_all['max_date'] < date.today() - timedelta(days=date.today().weekday() + 7)) | (pd.isnull(df_all['max_date']))]
-    return to_remind
+    today = date.today()
+    return db_access.get_groups_to_remind(today - timedelta(days=today.weekday() + 7), ENGINE)
+
+
+class CampaignReport:
+    def __init__(self):
+        self.sent_to = []
+        self.failed = []
+        self.skipped = []  # leaders who have never started the bot
+        self.total = 0  # reminders to send
+        self.cancelled = False
+        self.timings = {}
+
+    @contextmanager
+    def measure(self, step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[step] = time.perf_counter() - start
+
+    def __str__(self):
+        timings = ', '.join(f'{step} {seconds:.2f}s' for step, seconds in self.timings.items())
+        cancelled = ', cancelled' if self.cancelled else ''
+        return f'sent {len(self.sent_to)} of {self.total}, failed {len(self.failed)}, skipped {len(self.skipped)}' \
+               f'{cancelled} ({timings})'
+
 
+# progress(report) is called after each reminder sent or failed, the campaign stops sending once cancelled
+# (a threading.Event) is set
+def run_reminder_campaign(progress=None, cancelled=None):
+    report = CampaignReport()
+    with report.measure('resolve'):
+        to_remind_df = get_users_for_reminder()
+    return process_reminders(to_remind_df, report, progress, cancelled)
 
-def process_reminders(to_remind_df):
+
+def process_reminders(to_remind_df, report=None, progress=None, cancelled=None):
+    import pandas as pd
     logger.info('Started processing reminders')
-    sent_to = []
-    reminder_message_templates = db_access.get_multi_key_value('reminder_template', ENGINE)
-    reminder_message_template = random.choice(reminder_message_templates)
-
-    for i, row in to_remind_df.iterrows():
-        id_hg = row['id_hg']
-        leader = row['leader']
-        leader_username = row['leader_username']
-        max_date = row['max_date']
-        date_text = format_date(max_date) if max_date is not None else ''
-        logger.info(f'Processing {id_hg} (leader_username = {leader_username}, max date = {max_date})')
-
-        reminder_message = reminder_message_template.format(id_hg=id_hg, date_text=date_text)
-        user_data = db_access.get_user_data(leader_username, ENGINE)
-
-        if len(user_data) > 0:
-            telegram_uid = user_data[0][1]
-            try:
-                send_message(telegram_uid, reminder_message)
-                sent_to.append(f'{leader} (@{leader_username})')
-            except Exception as e:
-                logger.exception(e)
-    logger.info('Finished processing reminders')
-    return sent_to
+    report = report if report is not None else CampaignReport()
+
+    with report.measure('render'):
+        reminder_message_templates = key_value_cache.KEY_VALUES.get_multi('reminder_template')
+        reminder_message_template = random.choice(reminder_message_templates)
+        reminders = []
+        for row in to_remind_df.itertuples():
+            max_date = row.max_date
+            date_text = format_date(max_date) if max_date is not None and not pd.isnull(max_date) else ''
+            logger.info(f'Processing {row.id_hg} (leader_username = {row.leader_username}, max date = {max_date})')
+            leader_text = f'{row.leader} (@{row.leader_username})'
+            if pd.isnull(row.telegram_uid):
+                report.skipped.append(leader_text)
+                metrics.REMINDERS_SENT.inc(kind='campaign', outcome='skipped')
+                continue
+            reminder_message = reminder_message_template.format(id_hg=row.id_hg, date_text=date_text)
+            reminders.append((leader_text, int(row.telegram_uid), reminder_message))
+    report.total = len(reminders)
+
+    # Up to about a second of reminders is queued at a time: the outbound dispatcher sends them concurrently within
+    # the rate limits, and a cancelled campaign stops after the reminders already queued
+    window = max(1, int(config.outbound_bot_rate))
+    with report.measure('send'):
+        sending = deque()
+        for leader_text, telegram_uid, reminder_message in reminders:
+            if cancelled is not None and cancelled.is_set():
+                report.cancelled = True
+                break
+            sending.append((leader_text, submit_message(telegram_uid, reminder_message)))
+            if len(sending) >= window:
+                wait_for_reminder(report, progress, *sending.popleft())
+        while sending:
+            wait_for_reminder(report, progress, *sending.popleft())
+    logger.info(f'Finished processing reminders: {report}')
+    return report
+
+
+def wait_for_reminder(report, progress, leader_text, future):
+    try:
+        future.result(timeout=config.outbound_result_timeout)
+        report.sent_to.append(leader_text)
+        metrics.REMINDERS_SENT.inc(kind='campaign', outcome='sent')
+    except Exception as e:
+        log_not_sent(leader_text, e)
+        report.failed.append(leader_text)
+        metrics.REMINDERS_SENT.inc(kind='campaign', outcome='failed')
+    if progress is not None:
+        progress(report)
+
+
+# The outbound dispatcher logs the calls that failed, only a reminder still queued after the timeout is logged here
+def log_not_sent(leader, e):
+    if isinstance(e, concurrent.futures.TimeoutError):
+        logger.error(f'Reminder to {leader} not sent within {config.outbound_result_timeout}s')
 
 
 def send_reminder_before_hg(id_hg, time_of_hg):
-    message_templates = db_access.get_multi_key_value('reminder_before_hg_template', ENGINE)
+    message_templates = key_value_cache.KEY_VALUES.get_multi('reminder_before_hg_template')
     message_template = random.choice(message_templates)
     message = message_template.format(time_of_hg=time_of_hg)
-    send_reminder_before_after_hg(id_hg, message)
+    send_reminder_before_after_hg(id_hg, message, 'before_hg')
 
 
 def send_reminder_after_hg(id_hg):
-    message_templates = db_access.get_multi_key_value('reminder_after_hg_template', ENGINE)
+    message_templates = key_value_cache.KEY_VALUES.get_multi('reminder_after_hg_template')
     message_template = random.choice(message_templates)
-    send_reminder_before_after_hg(id_hg, message_template)
+    send_reminder_before_after_hg(id_hg, message_template, 'after_hg')
 
 
-def send_reminder_before_after_hg(id_hg, message):
-    leader_username = db_access.get_leader_username_for_hg(id_hg, ENGINE)
-    user_data = db_access.get_user_data(leader_username, ENGINE)
+def send_reminder_before_after_hg(id_hg, message, kind):
+    leader_username, telegram_uid = db_access.get_leader_uid_for_hg(id_hg, ENGINE)
 
-    if leader_username is not None and len(user_data) > 0:
-        telegram_uid = user_data[0][1]
+    if leader_username is not None and telegram_uid is not None:
         try:
             send_message(telegram_uid, message)
+            metrics.REMINDERS_SENT.inc(kind=kind, outcome='sent')
         except Exception as e:
-            logger.exception(e)
+            log_not_sent(leader_username, e)
+            metrics.REMINDERS_SENT.inc(kind=kind, outcome='failed')
+    else:
+        metrics.REMINDERS_SENT.inc(kind=kind, outcome='skipped')
 
 
 def send_message(telegram_uid, reminder_message):
+    submit_message(telegram_uid, reminder_message).result(timeout=config.outbound_result_timeout)
+
+
+def submit_message(telegram_uid, reminder_message):
+    # every reminder is logged: the log is how a leader's missing reminder is looked into
     logger.info(f'Sending reminder to {telegram_uid}: {reminder_message}')
-    bot.send_message(telegram_uid, reminder_message)
+    return outbound.submit(bot, 'send_message', telegram_uid, telegram_uid, reminder_message, lane=outbound.BULK)
 
 
 def send_message_fake(telegram_uid, reminder_message):
@@ -90,4 +165,5 @@ def send_message_fake(telegram_uid, reminder_message):
 
 
 def format_date(date):
+    import babel.dates
     return babel.dates.format_date(date, 'd MMMM yyyy г.', 'ru')
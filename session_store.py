@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import threading
+import time
+from loguru import logger
+
+SESSIONS_TABLE = 'data_from_bot_sessions'
+
+
+# Backends for report sessions: every backend keeps a JSON document per user_id with the time it was saved.
+# Documents older than the session TTL are not restored.
+
+class MemorySessionStore:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, user_id, ttl_in_seconds):
+        with self._lock:
+            saved = self._data.get(user_id)
+        if saved is None or time.time() - saved[1] > ttl_in_seconds:
+            return None
+        return json.loads(saved[0])
+
+    def save(self, user_id, data):
+        saved = (json.dumps(data, ensure_ascii=False), time.time())
+        with self._lock:
+            self._data[user_id] = saved
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def purge(self, ttl_in_seconds):
+        min_saved_ts = time.time() - ttl_in_seconds
+        with self._lock:
+            for user_id in [user_id for user_id, saved in self._data.items() if saved[1] < min_saved_ts]:
+                del self._data[user_id]
+
+
+class SqliteSessionStore:
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {SESSIONS_TABLE} '
+            '(user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, saved_ts REAL NOT NULL)')
+        self._lock = threading.Lock()
+
+    def load(self, user_id, ttl_in_seconds):
+        with self._lock:
+            row = self._connection.execute(
+                f'SELECT data FROM {SESSIONS_TABLE} WHERE user_id = ? AND saved_ts >= ?',
+                (user_id, time.time() - ttl_in_seconds)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, user_id, data):
+        with self._lock:
+            self._connection.execute(
+                f'INSERT INTO {SESSIONS_TABLE} (user_id, data, saved_ts) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, saved_ts = excluded.saved_ts',
+                (user_id, json.dumps(data, ensure_ascii=False), time.time()))
+
+    def delete(self, user_id):
+        with self._lock:
+            self._connection.execute(f'DELETE FROM {SESSIONS_TABLE} WHERE user_id = ?', (user_id,))
+
+    def purge(self, ttl_in_seconds):
+        with self._lock:
+            self._connection.execute(f'DELETE FROM {SESSIONS_TABLE} WHERE saved_ts < ?',
+                                     (time.time() - ttl_in_seconds,))
+
+
+class PostgresSessionStore:
+    def __init__(self, engine):
+        self._engine = engine
+        self._engine.execute(
+            f'CREATE TABLE IF NOT EXISTS {SESSIONS_TABLE} '
+            '(user_id bigint PRIMARY KEY, data text NOT NULL, saved_ts timestamp NOT NULL DEFAULT now())')
+
+    def load(self, user_id, ttl_in_seconds):
+        rows = list(self._engine.execute(
+            f"SELECT data FROM {SESSIONS_TABLE} WHERE user_id = %s AND saved_ts >= now() - %s * interval '1 second'",
+            (user_id, ttl_in_seconds)))
+        return json.loads(rows[0][0]) if rows else None
+
+    def save(self, user_id, data):
+        self._engine.execute(
+            f'INSERT INTO {SESSIONS_TABLE} (user_id, data, saved_ts) VALUES (%s, %s, now()) '
+            'ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, saved_ts = excluded.saved_ts',
+            (user_id, json.dumps(data, ensure_ascii=False)))
+
+    def delete(self, user_id):
+        self._engine.execute(f'DELETE FROM {SESSIONS_TABLE} WHERE user_id = %s', (user_id,))
+
+    def purge(self, ttl_in_seconds):
+        self._engine.execute(f"DELETE FROM {SESSIONS_TABLE} WHERE saved_ts < now() - %s * interval '1 second'",
+                             (ttl_in_seconds,))
+
+
+def create_session_store(backend, engine=None, sqlite_path=None):
+    logger.info(f'Using {backend} session store')
+    if backend == 'memory':
+        return MemorySessionStore()
+    elif backend == 'sqlite':
+        return SqliteSessionStore(sqlite_path)
+    elif backend == 'postgres':
+        return PostgresSessionStore(engine)
+    raise ValueError(f'Unknown session backend: {backend}')
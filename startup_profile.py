@@ -0,0 +1,35 @@
+import time
+from contextlib import contextmanager
+
+# Timings of the startup phases, reported by `python hgbot.py --profile-startup`
+STARTED = time.perf_counter()
+TIMINGS = []
+_last_mark = STARTED
+
+
+def mark(phase):
+    global _last_mark
+    now = time.perf_counter()
+    TIMINGS.append((phase, now - _last_mark))
+    _last_mark = now
+
+
+@contextmanager
+def measure(phase):
+    global _last_mark
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _last_mark = time.perf_counter()
+        TIMINGS.append((phase, _last_mark - start))
+
+
+def total():
+    return time.perf_counter() - STARTED
+
+
+def report():
+    lines = [f'{phase:<40}{duration * 1000:>10.1f} ms' for phase, duration in TIMINGS]
+    lines.append(f'{"total since start":<40}{total() * 1000:>10.1f} ms')
+    return '\n'.join(lines)
@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import auth_index
+
+
+def make_users(*usernames):
+    return {username: {'user_id': None, 'username': username, 'hgs': [{'group_id': 'HG-001', 'leader': 'Лидер'}]}
+            for username in usernames}
+
+
+def from_user(user_id, username):
+    return SimpleNamespace(id=user_id, username=username)
+
+
+class AuthIndexTest(unittest.TestCase):
+    def test_find_user_by_id_and_by_username(self):
+        index = auth_index.AuthIndex(make_users('anna', 'boris'), ['admin'])
+        self.assertEqual(index.find_user(from_user(1, 'anna'))['username'], 'anna')
+        index.set_user_id('anna', 1)
+        self.assertIs(index.by_user_id[1], index.by_username['anna'])
+        self.assertIsNone(index.find_user(from_user(3, 'unknown')))
+        self.assertTrue(index.is_admin(from_user(4, 'admin')))
+        self.assertFalse(index.is_admin(from_user(1, 'anna')))
+
+    def test_changed_username_is_checked(self):
+        index = auth_index.AuthIndex(make_users('anna'), [])
+        index.set_user_id('anna', 1)
+        # the telegram id alone does not grant access once the username is not a leader's any more
+        self.assertIsNone(index.find_user(from_user(1, 'anna_new')))
+
+    def test_refresh_keeps_learned_ids(self):
+        previous = auth_index.AuthIndex(make_users('anna', 'boris'), [])
+        previous.set_user_id('anna', 1)
+        previous.set_user_id('boris', 2)
+        index = auth_index.AuthIndex(make_users('anna', 'vera'), [], previous=previous)
+        self.assertEqual(index.by_username['anna']['user_id'], 1)
+        self.assertEqual(set(index.by_user_id), {1})
+        self.assertIsNone(index.by_username['vera']['user_id'])
+
+    def test_refresh_during_logins(self):
+        usernames = [f'user{n}' for n in range(2000)]
+        previous = auth_index.AuthIndex(make_users(*usernames), [])
+        errors = []
+
+        def login():
+            try:
+                for user_id, username in enumerate(usernames):
+                    previous.set_user_id(username, user_id)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=login)
+        thread.start()
+        while thread.is_alive():
+            try:
+                auth_index.AuthIndex(make_users(*usernames), [], previous=previous)
+            except Exception as e:
+                errors.append(e)
+        thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
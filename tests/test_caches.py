@@ -0,0 +1,178 @@
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import markup_cache
+import roster_cache
+
+
+# Loader for RosterCache that can be held in the middle of a load
+class BlockingLoader:
+    def __init__(self, rosters):
+        self.rosters = rosters
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, group_id):
+        self.calls.append(group_id)
+        roster = self.rosters[group_id]  # read at the start of the load, like the query would
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(roster, Exception):
+            raise roster
+        return list(roster)
+
+
+def run_in_thread(function, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', function(*args)))
+    thread.start()
+    return thread, result
+
+
+class RosterCacheTest(unittest.TestCase):
+    def test_hit_within_ttl(self):
+        loader = BlockingLoader({'HG-001': ['Анна', 'Борис']})
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        self.assertEqual(rosters.get('HG-001'), ('Анна', 'Борис'))
+        self.assertEqual(rosters.get('HG-001'), ('Анна', 'Борис'))
+        self.assertEqual(loader.calls, ['HG-001'])
+        self.assertEqual(rosters.stats(), {'groups': 1, 'hits': 1, 'misses': 1, 'loads': 1})
+
+    def test_reloaded_after_ttl(self):
+        loader = BlockingLoader({'HG-001': ['Анна']})
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        now = [1000.0]
+        with mock.patch.object(roster_cache.time, 'monotonic', lambda: now[0]):
+            members, version = rosters.get_versioned('HG-001')
+            now[0] += 61
+            self.assertEqual(rosters.get_versioned('HG-001'), (members, version + 1))
+        self.assertEqual(len(loader.calls), 2)
+
+    def test_concurrent_misses_share_one_load(self):
+        loader = BlockingLoader({'HG-001': ['Анна']})
+        loader.release.clear()
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        threads = [run_in_thread(rosters.get_versioned, 'HG-001') for _ in range(5)]
+        self.assertTrue(loader.started.wait(5))
+        loader.release.set()
+        for thread, result in threads:
+            thread.join(5)
+        self.assertEqual(loader.calls, ['HG-001'])
+        self.assertEqual({result['value'] for thread, result in threads}, {(('Анна',), 1)})
+
+    def test_load_invalidated_meanwhile_is_not_stored(self):
+        loader = BlockingLoader({'HG-001': ['Анна']})
+        loader.release.clear()
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        thread, result = run_in_thread(rosters.get_versioned, 'HG-001')
+        self.assertTrue(loader.started.wait(5))
+        rosters.invalidate('HG-001')
+        loader.rosters['HG-001'] = ['Анна', 'Вера']
+        loader.release.set()
+        thread.join(5)
+        self.assertEqual(result['value'], (('Анна',), None))
+        # the next get loads the roster again instead of waiting for the dropped load
+        self.assertEqual(rosters.get('HG-001'), ('Анна', 'Вера'))
+        self.assertEqual(len(loader.calls), 2)
+
+    def test_invalidating_another_group_keeps_the_load(self):
+        loader = BlockingLoader({'HG-001': ['Анна'], 'HG-002': ['Борис']})
+        loader.release.clear()
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        thread, result = run_in_thread(rosters.get_versioned, 'HG-001')
+        self.assertTrue(loader.started.wait(5))
+        rosters.invalidate('HG-002')
+        loader.release.set()
+        thread.join(5)
+        self.assertEqual(result['value'], (('Анна',), 1))
+        self.assertEqual(rosters.stats()['groups'], 1)
+
+    def test_full_invalidation_drops_all_rosters(self):
+        loader = BlockingLoader({'HG-001': ['Анна'], 'HG-002': ['Борис']})
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        rosters.get('HG-001')
+        rosters.get('HG-002')
+        rosters.invalidate()
+        self.assertEqual(rosters.stats()['groups'], 0)
+        rosters.get('HG-001')
+        self.assertEqual(loader.calls, ['HG-001', 'HG-002', 'HG-001'])
+
+    def test_load_error_reaches_the_waiters(self):
+        loader = BlockingLoader({'HG-001': ConnectionError('database is down')})
+        loader.release.clear()
+        rosters = roster_cache.RosterCache(loader, ttl_in_seconds=60)
+        errors = []
+
+        def get():
+            try:
+                rosters.get('HG-001')
+            except ConnectionError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(loader.started.wait(5))
+        loader.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(loader.calls, ['HG-001'])
+
+
+# Stands in for a telebot keyboard
+class FakeMarkup:
+    def __init__(self, text):
+        self.text = text
+
+    def to_json(self):
+        return f'{{"text": "{self.text}"}}'
+
+
+class MarkupCacheTest(unittest.TestCase):
+    def test_static_markup_is_built_once(self):
+        markups = markup_cache.MarkupCache()
+        builds = []
+        build = lambda: builds.append(1) or FakeMarkup('dates')
+        self.assertEqual(markups.static('dates', build), '{"text": "dates"}')
+        self.assertEqual(markups.static('dates', build), '{"text": "dates"}')
+        self.assertEqual(len(builds), 1)
+        markups.clear()
+        markups.static('dates', build)
+        self.assertEqual(len(builds), 2)
+
+    def test_roster_markup_is_cached_per_version(self):
+        markups = markup_cache.MarkupCache()
+        build = lambda members: FakeMarkup(','.join(members))
+        self.assertEqual(markups.roster(('HG-001', 0), 1, ('Анна',), build), '{"text": "Анна"}')
+        self.assertEqual(markups.roster(('HG-001', 0), 1, ('Анна', 'Вера'), build), '{"text": "Анна"}')
+        self.assertEqual(markups.roster(('HG-001', 0), 2, ('Анна', 'Вера'), build), '{"text": "Анна,Вера"}')
+        self.assertEqual((markups.hits, markups.builds), (1, 2))
+
+    def test_roster_without_version_is_not_cached(self):
+        markups = markup_cache.MarkupCache()
+        build = lambda members: FakeMarkup(','.join(members))
+        markups.roster(('HG-001', 0), None, ('Анна',), build)
+        markups.roster(('HG-001', 0), None, ('Анна',), build)
+        self.assertEqual((markups.hits, markups.builds), (0, 2))
+        self.assertEqual(markups.stats()['rosters'], 0)
+
+    def test_least_recently_used_rosters_are_dropped(self):
+        markups = markup_cache.MarkupCache(max_rosters=2)
+        build = lambda members: FakeMarkup(','.join(members))
+        for group_id in ('HG-001', 'HG-002'):
+            markups.roster(group_id, 1, (group_id,), build)
+        markups.roster('HG-001', 1, ('HG-001',), build)
+        markups.roster('HG-003', 1, ('HG-003',), build)
+        self.assertEqual(list(markups._rosters), ['HG-001', 'HG-003'])
+
+
+if __name__ == '__main__':
+    unittest.main()
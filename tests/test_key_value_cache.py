@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# config reads the secrets at import, no connection is made while the engine is not used
+for name in ('DB_USER', 'DB_PASSWORD', 'DB_HOSTNAME', 'DB_NAME', 'BOT_TOKEN', 'SENTRY_URL', 'ADMINS'):
+    os.environ.setdefault(name, 'test')
+
+import key_value_cache
+
+
+# Stands in for the key_value_storage queries of db_access
+class FakeKeyValueStorage:
+    def __init__(self, values):
+        self.values = values
+        self.version = 1
+        self.down = False
+        self.version_queries = 0
+        self.loads = 0
+
+    def get_key_value_version(self, engine):
+        self.version_queries += 1
+        if self.down:
+            raise ConnectionError('database is down')
+        return self.version
+
+    def get_all_key_values(self, engine):
+        self.loads += 1
+        return {key: list(values) for key, values in self.values.items()}
+
+
+class KeyValueSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = FakeKeyValueStorage({'feedback_message': ['Спасибо!'], 'reasons': ['Болеет', 'Работа']})
+        for name in ('get_key_value_version', 'get_all_key_values'):
+            patcher = mock.patch.object(key_value_cache.db_access, name, getattr(self.storage, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.now = 1000.0
+        patcher = mock.patch.object(key_value_cache.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.snapshot = key_value_cache.KeyValueSnapshot(lambda: None, check_interval_in_seconds=30)
+
+    def test_reads_are_served_from_memory_within_the_interval(self):
+        self.assertEqual(self.snapshot.get_single('feedback_message'), 'Спасибо!')
+        self.assertEqual(self.snapshot.get_multi('reasons'), ['Болеет', 'Работа'])
+        self.assertEqual(self.snapshot.get_multi('missing'), [])
+        self.assertEqual((self.storage.version_queries, self.storage.loads), (1, 1))
+
+    def test_reloaded_only_when_the_version_changes(self):
+        self.snapshot.get_multi('reasons')
+        self.now += 31
+        self.snapshot.get_multi('reasons')
+        self.assertEqual((self.storage.version_queries, self.storage.loads), (2, 1))
+        self.storage.values['reasons'] = ['Болеет']
+        self.storage.version = 2
+        self.now += 31
+        self.assertEqual(self.snapshot.get_multi('reasons'), ['Болеет'])
+        self.assertEqual(self.storage.loads, 2)
+
+    def test_get_single_requires_one_value(self):
+        with self.assertRaises(ValueError):
+            self.snapshot.get_single('reasons')
+
+    def test_failed_check_is_retried_after_the_interval(self):
+        self.snapshot.get_multi('reasons')
+        self.storage.down = True
+        self.now += 31
+        for _ in range(5):
+            self.assertEqual(self.snapshot.get_multi('reasons'), ['Болеет', 'Работа'])
+        self.assertEqual(self.storage.version_queries, 2)
+        self.now += 31
+        self.snapshot.get_multi('reasons')
+        self.assertEqual(self.storage.version_queries, 3)
+
+    def test_first_load_failure_is_raised(self):
+        self.storage.down = True
+        with self.assertRaises(ConnectionError):
+            self.snapshot.get_multi('reasons')
+
+
+if __name__ == '__main__':
+    unittest.main()
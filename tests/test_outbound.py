@@ -0,0 +1,152 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# config reads the secrets at import, no connection is made while the engine is not used
+for name in ('DB_USER', 'DB_PASSWORD', 'DB_HOSTNAME', 'DB_NAME', 'BOT_TOKEN', 'SENTRY_URL', 'ADMINS'):
+    os.environ.setdefault(name, 'test')
+
+from telebot.apihelper import ApiTelegramException
+
+import outbound
+
+
+# Stands in for telebot.TeleBot: records the calls, send_message can be held until released
+class FakeBot:
+    token = '1:test'
+
+    def __init__(self, latency_seconds=0):
+        self.latency_seconds = latency_seconds
+        self.started = []  # texts, in the order the calls started
+        self.calls = []  # (method_name, chat_id, text), in the order the calls finished
+        self.in_flight = {}  # chat_id: calls running now
+        self.max_in_flight = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.errors = []  # raised by the next calls, in order
+        self._lock = threading.Lock()
+
+    def _call(self, method_name, chat_id, text):
+        with self._lock:
+            self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight[chat_id])
+            error = self.errors.pop(0) if self.errors else None
+            self.started.append(text)
+        try:
+            self.release.wait(5)
+            time.sleep(self.latency_seconds)
+            with self._lock:
+                self.calls.append((method_name, chat_id, text))
+            if error is not None:
+                raise error
+            return text
+        finally:
+            with self._lock:
+                self.in_flight[chat_id] -= 1
+
+    def send_message(self, chat_id, text):
+        return self._call('send_message', chat_id, text)
+
+    def edit_message_reply_markup(self, chat_id, text):
+        return self._call('edit_message_reply_markup', chat_id, text)
+
+
+def too_many_requests(retry_after=0):
+    answer = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+              'parameters': {'retry_after': retry_after}}
+    return ApiTelegramException('sendMessage', None, answer)
+
+
+class OutboundDispatcherTest(unittest.TestCase):
+    def start_dispatcher(self, workers=1, max_retries=3):
+        dispatcher = outbound.OutboundDispatcher(bot_rate=100000, chat_rate=100000, chat_burst=100000,
+                                                 workers=workers, max_retries=max_retries)
+        dispatcher.start()
+        return dispatcher
+
+    def test_interactive_goes_ahead_of_queued_bulk(self):
+        bot = FakeBot()
+        bot.release.clear()
+        dispatcher = self.start_dispatcher(workers=2)
+        bulk = [dispatcher.submit(bot, 'send_message', 100 + n, 100 + n, 'bulk', lane=outbound.BULK) for n in range(20)]
+        time.sleep(0.1)  # the senders are busy with the first bulk calls
+        interactive = dispatcher.submit(bot, 'send_message', 1, 1, 'interactive')
+        bot.release.set()
+        interactive.result(5)
+        for future in bulk:
+            future.result(5)
+        # only the calls already running when it was submitted are started before it
+        self.assertEqual(bot.started.index('interactive'), 2)
+
+    def test_queued_edits_are_coalesced(self):
+        bot = FakeBot()
+        bot.release.clear()
+        dispatcher = self.start_dispatcher()
+        first = dispatcher.submit(bot, 'send_message', 1, 1, 'message')
+        time.sleep(0.1)
+        edits = [dispatcher.submit(bot, 'edit_message_reply_markup', 1, 1, f'keyboard {n}', coalesce_key=(1, 'markup'))
+                 for n in range(3)]
+        bot.release.set()
+        first.result(5)
+        self.assertEqual(edits[2].result(5), 'keyboard 2')
+        self.assertIs(edits[0], edits[2])
+        self.assertEqual(bot.calls, [('send_message', 1, 'message'), ('edit_message_reply_markup', 1, 'keyboard 2')])
+        self.assertEqual(dispatcher.stats()['coalesced'], 2)
+
+    def test_rate_limited_call_is_retried(self):
+        bot = FakeBot()
+        bot.errors = [too_many_requests()]
+        dispatcher = self.start_dispatcher()
+        self.assertEqual(dispatcher.submit(bot, 'send_message', 1, 1, 'hello').result(5), 'hello')
+        self.assertEqual(len(bot.calls), 2)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['rate_limited'], stats['failed'], stats['sent']), (1, 0, {'send_message': 1}))
+
+    def test_rate_limited_call_fails_after_max_retries(self):
+        bot = FakeBot()
+        bot.errors = [too_many_requests(), too_many_requests()]
+        dispatcher = self.start_dispatcher(max_retries=1)
+        with self.assertRaises(ApiTelegramException):
+            dispatcher.submit(bot, 'send_message', 1, 1, 'hello').result(5)
+        self.assertEqual(dispatcher.stats()['failed'], 1)
+
+    def test_calls_to_one_chat_keep_their_order(self):
+        bot = FakeBot(latency_seconds=0.005)
+        dispatcher = self.start_dispatcher(workers=4)
+        futures = [dispatcher.submit(bot, 'send_message', chat_id, chat_id, str(n))
+                   for n in range(10) for chat_id in (1, 2)]
+        for future in futures:
+            future.result(5)
+        for chat_id in (1, 2):
+            self.assertEqual([text for _, c, text in bot.calls if c == chat_id], [str(n) for n in range(10)])
+        self.assertEqual(bot.max_in_flight, 1)
+
+    def test_tally_counts_calls_made(self):
+        bot = FakeBot()
+        bot.release.clear()
+        dispatcher = self.start_dispatcher()
+        dispatcher.start_tally(1)
+        dispatcher.submit(bot, 'send_message', 1, 1, 'keyboard')
+        time.sleep(0.1)
+        for n in range(3):
+            dispatcher.submit(bot, 'edit_message_reply_markup', 1, 1, f'keyboard {n}', coalesce_key=(1, 'markup'))
+        dispatcher.submit(bot, 'send_message', None, 1, 'answer', tally_chat_id=1)
+        dispatcher.submit(bot, 'send_message', 2, 2, 'other chat')
+        done = threading.Event()
+        tallies = []
+        self.assertTrue(dispatcher.end_tally(1, lambda calls: (tallies.append(calls), done.set())))
+        dispatcher.submit(bot, 'send_message', 1, 1, 'after the tally')
+        self.assertEqual(tallies, [])  # the calls are still queued
+        bot.release.set()
+        self.assertTrue(done.wait(5))
+        # the three edits were sent as one
+        self.assertEqual(tallies, [3])
+        self.assertFalse(dispatcher.end_tally(1, tallies.append))
+
+
+if __name__ == '__main__':
+    unittest.main()
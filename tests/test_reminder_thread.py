@@ -0,0 +1,82 @@
+import os
+import sys
+import threading
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# config reads the secrets at import, no connection is made while the engine is not used
+for name in ('DB_USER', 'DB_PASSWORD', 'DB_HOSTNAME', 'DB_NAME', 'BOT_TOKEN', 'SENTRY_URL', 'ADMINS'):
+    os.environ.setdefault(name, 'test')
+
+import reminder_thread
+
+
+class ReminderThreadTest(unittest.TestCase):
+    def start_thread(self):
+        thread = reminder_thread.ReminderThread()
+        thread.init_jobs = lambda: None
+        thread.start()
+        return thread
+
+    def test_due_group_job_gets_id_hg(self):
+        sent = threading.Event()
+        calls = []
+
+        def send_reminder_before_hg(id_hg, time_of_hg):
+            calls.append((id_hg, time_of_hg))
+            sent.set()
+
+        with mock.patch.object(reminder_thread.send_reminders, 'send_reminder_before_hg', send_reminder_before_hg):
+            thread = self.start_thread()
+            job = reminder_thread.ReminderJob('send_reminders_before_hg', thread.send_reminders_before_hg,
+                                              interval=timedelta(hours=1), id_hg='HG-001', time_of_hg='19:00')
+            thread.add_job(job)
+            with thread._condition:
+                job.next_run -= timedelta(hours=2)
+                thread._heap = [(job.next_run, seq, j) for _, seq, j in thread._heap]
+                thread._condition.notify()
+            self.assertTrue(sent.wait(5))
+        self.assertEqual(calls, [('HG-001', '19:00')])
+
+    def test_failing_job_is_rescheduled(self):
+        runs = []
+        thread = self.start_thread()
+
+        def fail():
+            runs.append(1)
+            raise RuntimeError('failed')
+
+        job = reminder_thread.ReminderJob('failing', fail, interval=timedelta(milliseconds=20))
+        thread.add_job(job)
+        for _ in range(100):
+            if len(runs) >= 2:
+                break
+            threading.Event().wait(0.05)
+        self.assertGreaterEqual(len(runs), 2)
+        self.assertTrue(thread.is_alive())
+
+    def test_weekly_reminders_skipped_while_campaign_runs(self):
+        runner = reminder_thread.campaign_runner.CampaignRunner()
+        busy = threading.Event()
+        runner.start('reminders', lambda cancelled: busy.wait(5))
+        started = []
+        thread = reminder_thread.ReminderThread()
+        with mock.patch.object(reminder_thread.campaign_runner, 'CAMPAIGNS', runner), \
+                mock.patch.object(reminder_thread.send_reminders, 'run_reminder_campaign',
+                                  lambda cancelled: started.append(1)):
+            thread.send_reminders_for_old_hgs()
+            busy.set()
+            for _ in range(100):
+                if not runner.is_running():
+                    break
+                threading.Event().wait(0.01)
+        # nothing is queued to run the same reminders again after the admin's run
+        self.assertEqual(thread.upcoming_jobs(), [])
+        self.assertEqual(started, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
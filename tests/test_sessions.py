@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import report_session
+import session_store
+
+
+class SessionStoreTest(unittest.TestCase):
+    def stores(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return [session_store.MemorySessionStore(),
+                session_store.SqliteSessionStore(os.path.join(directory.name, 'sessions.sqlite3'))]
+
+    def test_save_load_delete(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                store.save(1, {'state': 2, 'visitors': {'Анна': {'status': '+'}}})
+                self.assertEqual(store.load(1, 60), {'state': 2, 'visitors': {'Анна': {'status': '+'}}})
+                self.assertIsNone(store.load(2, 60))
+                store.delete(1)
+                self.assertIsNone(store.load(1, 60))
+
+    def test_expired_documents_are_not_loaded_and_purged(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                with mock.patch.object(session_store.time, 'time', return_value=time.time() - 120):
+                    store.save(1, {'state': 1})
+                store.save(2, {'state': 2})
+                self.assertIsNone(store.load(1, 60))
+                store.purge(60)
+                self.assertIsNone(store.load(1, 3600))
+                self.assertEqual(store.load(2, 60), {'state': 2})
+
+    def test_memory_store_purge_while_saving(self):
+        store = session_store.MemorySessionStore()
+        errors = []
+
+        def save(first):
+            try:
+                for user_id in range(first, first + 2000):
+                    store.save(user_id, {'state': 0})
+                    store.delete(user_id - 1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save, args=(n * 10000,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            store.purge(-1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class SessionRegistryTest(unittest.TestCase):
+    def test_session_is_restored_from_the_store(self):
+        store = session_store.MemorySessionStore()
+        sessions = report_session.SessionRegistry(ttl_in_seconds=60, max_sessions=1, store=store)
+        session = sessions.get(1)
+        session.username = 'leader'
+        session.date = date(2021, 9, 3)
+        session.visitors = {'Анна': {'status': '-', 'leader': 'Лидер', 'reason': 'Болеет'}}
+        sessions.save(session)
+        sessions.get(2)  # evicts user 1
+        self.assertIsNone(sessions.peek(1))
+        restored = sessions.find(1)
+        self.assertIsNot(restored, session)
+        self.assertEqual(restored.to_dict(), session.to_dict())
+        self.assertEqual(sessions.restored, 1)
+
+    def test_peek_does_not_touch_the_store(self):
+        store = mock.Mock()
+        sessions = report_session.SessionRegistry(ttl_in_seconds=60, max_sessions=10, store=store)
+        self.assertIsNone(sessions.peek(1))
+        store.load.assert_not_called()
+
+    def test_store_is_purged_periodically_on_save(self):
+        store = mock.Mock()
+        store.load.return_value = None
+        sessions = report_session.SessionRegistry(ttl_in_seconds=60, max_sessions=10, store=store)
+        sessions.save(sessions.get(1))
+        store.purge.assert_not_called()
+        with mock.patch.object(report_session, 'STORE_PURGE_INTERVAL_IN_SECONDS', 0):
+            sessions.save(sessions.get(1))
+            sessions.save(sessions.get(1))
+        self.assertEqual(store.purge.call_count, 2)
+        store.purge.assert_called_with(60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+
+def get_update_user_id(update):
+    if update.message is not None:
+        return update.message.from_user.id
+    if update.callback_query is not None:
+        return update.callback_query.from_user.id
+    return None
+
+
+# Runs the bot handlers for many users at the same time. Updates of one user are handled strictly one after another
+# in the order they arrived; the handlers (blocking on Postgres and the Bot API) run on a bounded thread pool.
+class UpdatePipeline:
+    def __init__(self, bot, workers, max_pending):
+        self.bot = bot
+        # handlers are run right in the pipeline workers, not in the telebot worker pool
+        self.bot.threaded = False
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='UpdateWorker')
+        self.max_pending = max_pending
+        self.loop = None
+        self._pending = None
+        self._last_tasks = {}  # user_id: task handling the latest update of the user
+        self._accepted = 0  # updates accepted by try_submit_threadsafe and not handled yet
+        self._accepted_lock = threading.Lock()  # also guards the counters updated by the workers
+        self.handled = 0
+        self.failed = 0
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._pending = asyncio.Semaphore(self.max_pending)
+
+    async def submit(self, update):
+        await self._pending.acquire()
+        user_id = get_update_user_id(update)
+        previous_task = self._last_tasks.get(user_id) if user_id is not None else None
+        task = self.loop.create_task(self._handle(update, previous_task))
+        if user_id is not None:
+            self._last_tasks[user_id] = task
+            task.add_done_callback(lambda t: self._forget(user_id, t))
+        return task
+
+    # For threads outside of the event loop (e.g. the webhook server). Returns False without waiting if max_pending
+    # updates are already accepted and not handled yet.
+    def try_submit_threadsafe(self, update):
+        with self._accepted_lock:
+            if self._accepted >= self.max_pending:
+                return False
+            self._accepted += 1
+        asyncio.run_coroutine_threadsafe(self._submit_accepted(update), self.loop)
+        return True
+
+    async def _submit_accepted(self, update):
+        try:
+            task = await self.submit(update)
+        except BaseException:
+            self._release_accepted()
+            raise
+        task.add_done_callback(lambda t: self._release_accepted())
+
+    def _release_accepted(self):
+        with self._accepted_lock:
+            self._accepted -= 1
+
+    async def drain(self):
+        while self._last_tasks:
+            await asyncio.gather(*self._last_tasks.values(), return_exceptions=True)
+
+    async def _handle(self, update, previous_task):
+        try:
+            if previous_task is not None:
+                await asyncio.wait([previous_task])
+            await self.loop.run_in_executor(self.executor, self._process, update)
+        finally:
+            self._pending.release()
+
+    # Runs in the workers
+    def _process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+            with self._accepted_lock:
+                self.handled += 1
+        except Exception as e:
+            with self._accepted_lock:
+                self.failed += 1
+            logger.exception(e)
+
+    def _forget(self, user_id, task):
+        if self._last_tasks.get(user_id) is task:
+            del self._last_tasks[user_id]
+
+    # Polls until SIGINT or SIGTERM, then waits for the updates already submitted. The updates of the poll in progress
+    # are not confirmed to Telegram (no getUpdates with a later offset), they are sent again after the restart.
+    async def poll(self, long_polling_timeout=20):
+        await self.start()
+        stopping = asyncio.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signal_number, stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # no signal handlers on Windows or outside the main thread
+        stop_requested = self.loop.create_task(stopping.wait())
+        offset = None
+        logger.info('Started polling with the update pipeline')
+        while True:
+            polling = self.loop.run_in_executor(
+                None, lambda: self.bot.get_updates(offset=offset, timeout=long_polling_timeout + 5,
+                                                   long_polling_timeout=long_polling_timeout))
+            await asyncio.wait([polling, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+            if stopping.is_set():
+                break
+            try:
+                updates = polling.result()
+            except Exception as e:
+                logger.exception(e)
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self.submit(update)
+        logger.info('Stopping: waiting for the updates in progress')
+        await self.drain()
+        self.executor.shutdown()
+        logger.info(f'Stopped, {self.handled} updates handled, {self.failed} failed')
+
+
+def run_polling(bot, workers, max_pending):
+    pipeline = UpdatePipeline(bot, workers, max_pending)
+    asyncio.run(pipeline.poll())
@@ -0,0 +1,127 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+from telebot import apihelper
+
+# Capture of the incoming updates and of the bot's replies for replaying a real load (benchmarks/replay_updates.py).
+# One JSON object per line, appended as the updates arrive:
+#   {"t": <unix time>, "update": <update>}
+#   {"t": <unix time>, "reply": {"chat": <chat id>, "method": <Bot API method>, "hash": <hash of the text>}}
+# User and chat ids are replaced by keyed hashes (the same user gets the same id within a recording made with the
+# same salt), names are dropped and the replies are stored as hashes. Usernames and the texts of the updates are
+# kept: the handlers authorize leaders by username and follow the report by the texts and buttons.
+
+# Callback queries waiting for an answer are remembered to record the answer with the chat of the user
+MAX_CALLBACK_CHATS = 10000
+
+
+def anonymize_id(value, salt):
+    digest = hmac.new(salt, str(value).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:6], 'big')
+
+
+def anonymize_user(user, salt):
+    return {'id': anonymize_id(user['id'], salt), 'is_bot': user.get('is_bot', False), 'first_name': 'anonymous',
+            'username': user.get('username')}
+
+
+def anonymize_chat(chat, salt):
+    return {'id': anonymize_id(chat['id'], salt), 'type': chat.get('type', 'private')}
+
+
+# Keeps only what the handlers read: the sender, the chat, the text of messages and the data of button clicks
+def anonymize_update(update, salt):
+    anonymized = {'update_id': update['update_id']}
+    message = update.get('message')
+    if message is not None:
+        anonymized['message'] = {'message_id': message['message_id'], 'date': message['date'],
+                                 'chat': anonymize_chat(message['chat'], salt)}
+        if 'from' in message:
+            anonymized['message']['from'] = anonymize_user(message['from'], salt)
+        if 'text' in message:
+            anonymized['message']['text'] = message['text']
+    callback_query = update.get('callback_query')
+    if callback_query is not None:
+        anonymized['callback_query'] = {'id': callback_query['id'], 'chat_instance': callback_query['chat_instance'],
+                                        'from': anonymize_user(callback_query['from'], salt),
+                                        'data': callback_query.get('data')}
+        message = callback_query.get('message')
+        if message is not None:
+            anonymized['callback_query']['message'] = {'message_id': message['message_id'], 'date': message['date'],
+                                                       'chat': anonymize_chat(message['chat'], salt)}
+    return anonymized
+
+
+# text of a message or a keyboard (markup object or its JSON)
+def hash_text(text):
+    if text is None:
+        return None
+    if hasattr(text, 'to_json'):
+        text = text.to_json()
+    return hashlib.sha256(str(text).encode()).hexdigest()[:12]
+
+
+class UpdateRecorder:
+    def __init__(self, path, salt):
+        self.path = path
+        self.salt = salt.encode() if salt else os.urandom(16)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._callback_chats = OrderedDict()  # callback query id: anonymized id of the user who clicked
+        self.recorded = 0
+
+    def _write(self, entry, update=False):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if update:
+                self.recorded += 1
+
+    def record_update(self, update):
+        try:
+            anonymized = anonymize_update(update, self.salt)
+            callback_query = anonymized.get('callback_query')
+            if callback_query is not None:
+                with self._lock:
+                    self._callback_chats[callback_query['id']] = callback_query['from']['id']
+                    if len(self._callback_chats) > MAX_CALLBACK_CHATS:
+                        self._callback_chats.popitem(last=False)
+            self._write({'t': round(time.time(), 3), 'update': anonymized}, update=True)
+        except Exception as e:
+            logger.warning(f'Could not record update: {e}')
+
+    def _write_reply(self, chat, method, text):
+        self._write({'t': round(time.time(), 3), 'reply': {'chat': chat, 'method': method, 'hash': hash_text(text)}})
+
+    def record_reply(self, chat_id, method, text=None):
+        self._write_reply(anonymize_id(chat_id, self.salt), method, text)
+
+    # answerCallbackQuery has no chat: it is the chat of the user who clicked
+    def record_callback_answer(self, call_id, text=None):
+        with self._lock:
+            chat = self._callback_chats.get(call_id)
+        self._write_reply(chat, 'answerCallbackQuery', text)
+
+    # Records the updates received by long polling (bot.polling and the update pipeline both go through
+    # apihelper.get_updates); the webhook server calls record_update itself
+    def install(self):
+        get_updates = apihelper.get_updates
+
+        def recording_get_updates(*args, **kwargs):
+            updates = get_updates(*args, **kwargs)
+            for update in updates:
+                self.record_update(update)
+            return updates
+
+        apihelper.get_updates = recording_get_updates
+        logger.info(f'Recording updates to {self.path}')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
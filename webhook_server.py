@@ -0,0 +1,91 @@
+import asyncio
+import hmac
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+from telebot import apihelper
+from telebot.types import Update
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Telegram sends an update again if the answer did not reach it: the ids of the last updates are remembered
+MAX_SEEN_UPDATE_IDS = 10000
+# Asked of Telegram when the pipeline is full
+RETRY_AFTER_IN_SECONDS = 5
+
+
+# Receives updates pushed by Telegram. The request is answered with 200 as soon as the update is parsed
+# and queued, the handlers run in the update pipeline. While the pipeline is full the answer is 429, and Telegram
+# sends the update again later.
+def create_server(pipeline, host, port, path, secret_token, recorder=None):
+    seen_update_ids = OrderedDict()
+    seen_lock = threading.Lock()
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_empty_response(404)
+                return
+            # compared as bytes: compare_digest raises TypeError for non-ASCII strings
+            if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, '').encode(), secret_token.encode()):
+                logger.warning(f'Webhook request with invalid secret token from {self.client_address[0]}')
+                self.send_empty_response(403)
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                raw_update = json.loads(body)
+                update = Update.de_json(raw_update)
+            except Exception as e:
+                logger.warning(f'Invalid webhook update: {e}')
+                self.send_empty_response(400)
+                return
+            with seen_lock:
+                if update.update_id in seen_update_ids:
+                    logger.debug(f'Webhook update {update.update_id} already received')
+                    self.send_empty_response(200)
+                    return
+                if not pipeline.try_submit_threadsafe(update):
+                    logger.warning(f'Update pipeline is full, update {update.update_id} is left to Telegram to resend')
+                    self.send_empty_response(429, {'Retry-After': str(RETRY_AFTER_IN_SECONDS)})
+                    return
+                seen_update_ids[update.update_id] = True
+                if len(seen_update_ids) > MAX_SEEN_UPDATE_IDS:
+                    seen_update_ids.popitem(last=False)
+            if recorder is not None:
+                recorder.record_update(raw_update)
+            self.send_empty_response(200)
+
+        def send_empty_response(self, code, headers=None):
+            self.send_response(code)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(f'[webhook] {format % args}')
+
+    return ThreadingHTTPServer((host, port), WebhookHandler)
+
+
+def set_webhook(bot, url, secret_token):
+    # secret_token is not supported by TeleBot.set_webhook of the pinned pyTelegramBotAPI version
+    apihelper._make_request(bot.token, 'setWebhook', method='post', params={'url': url, 'secret_token': secret_token})
+    logger.info(f'Webhook set to {url}')
+
+
+def run_webhook(bot, pipeline, host, port, path, secret_token, public_url=None, recorder=None):
+    if not secret_token:
+        raise ValueError('Webhook secret token is required (WEBHOOK_SECRET)')
+
+    async def serve():
+        await pipeline.start()
+        server = create_server(pipeline, host, port, path, secret_token, recorder)
+        threading.Thread(target=server.serve_forever, name='WebhookServer', daemon=True).start()
+        logger.info(f'Listening for webhook updates on http://{host}:{port}{path}')
+        if public_url:
+            set_webhook(bot, public_url, secret_token)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())